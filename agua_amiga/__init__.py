@@ -1,8 +1,14 @@
 # running this file should run the app
 import sys
-from agua_amiga.gui.application import Application
+
+from agua_amiga import startup_trace
+
 
 def run():
+    # imported here so other entry points (like agua_amiga_export) don't load Gtk
+    with startup_trace.phase('imports'):
+        from agua_amiga.gui.application import Application
+
     application = Application()
     try:
         application.run(sys.argv)
@@ -11,4 +17,4 @@ def run():
 
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run()
@@ -0,0 +1,531 @@
+"""
+Bluetooth scanner built on dbus-next's asyncio MessageBus instead of promise chains.
+
+It has the same interface as BluetoothScanner, so the app can use either. Select it with
+AGUA_AMIGA_BLUETOOTH=asyncio. The asyncio event loop runs on the GLib main loop through
+PyGObject's GLibEventLoopPolicy (PyGObject 3.50 or newer), so callbacks still arrive on the
+main loop like they do with BluetoothScanner.
+
+Every bottle is looked after by its own task, which keeps it connected and reconnects it with the
+same backoff as connection_manager. The scanner owns those tasks and cancels them when it stops,
+so nothing is left running once stop_scanner or close returns.
+"""
+import asyncio
+import os
+import time
+import traceback
+from typing import Any
+
+from dbus_next import BusType, DBusError, Variant
+from dbus_next.aio import MessageBus
+
+from gi.repository import GLib
+
+from agua_amiga import metrics, startup_trace
+from agua_amiga.bluetooth_scanner import (ADAPTER_IFACE, BLUEZ_BUS_NAME, BUS_ADDRESS_ENV, CHARACTERISTIC_IFACE,
+                                          CONNECT_ATTEMPTS, DEVICE_IFACE, OBJ_MANAGER_IFACE, PROPERTIES_IFACE,
+                                          BluetoothNotSupported, BluetoothStatus, BluezObjectTree,
+                                          CharacteristicNotifyHandler, SipStream, WaterBottle, connect_backoff_ms,
+                                          discovery_filter_variants)
+from agua_amiga.bottle_codecs import codec_for
+from agua_amiga.connection_manager import reconnect_delay_s
+from agua_amiga.device_registry import DeviceRegistry
+from agua_amiga.discovery import DiscoveryPolicy
+from agua_amiga.sip_journal import SipJournal
+
+try:
+    from gi.events import GLibEventLoopPolicy
+except ImportError:
+    GLibEventLoopPolicy = None
+
+def install_glib_event_loop_policy():
+    """
+    makes asyncio run its event loop on the GLib main loop, call before the app starts running
+    """
+    if GLibEventLoopPolicy is None:
+        raise BluetoothNotSupported("The asyncio Bluetooth stack needs PyGObject 3.50 or newer")
+
+    asyncio.set_event_loop_policy(GLibEventLoopPolicy())
+
+
+class AioProxyFactory:
+    """
+    asyncio version of ProxyFactory, introspection data is shared between objects with the same interfaces
+    """
+
+    def __init__(self, bus, object_tree: BluezObjectTree) -> None:
+        self.bus = bus
+        self.object_tree = object_tree
+        self._introspections = {}
+
+    async def get_proxy_object(self, bus_name, path):
+        interfaces = self.object_tree.objects.get(path)
+        if not interfaces:
+            return self.bus.get_proxy_object(bus_name, path, await self.bus.introspect(bus_name, path))
+
+        signature = (bus_name, frozenset(interfaces))
+        if signature not in self._introspections:
+            self._introspections[signature] = asyncio.ensure_future(self.bus.introspect(bus_name, path))
+
+        try:
+            introspection = await self._introspections[signature]
+        except Exception:
+            self._introspections.pop(signature, None)
+            raise
+
+        return self.bus.get_proxy_object(bus_name, path, introspection)
+
+
+class AioBtleDevice:
+
+    def __init__(self, path, device_proxy, object_tree: BluezObjectTree, proxy_factory: AioProxyFactory) -> None:
+        self.path = path
+        self.device_interface = device_proxy.get_interface(DEVICE_IFACE)
+        self.properties_interface = device_proxy.get_interface(PROPERTIES_IFACE)
+        self.object_tree = object_tree
+        self.proxy_factory = proxy_factory
+        self.characteristics = {}
+        # where the characteristics were found on the last connect, kept across reconnects
+        self.characteristic_paths = None
+        self.handlers = {}
+        self._writes = set()
+
+    async def connect(self):
+        services_resolved = asyncio.get_running_loop().create_future()
+
+        def _services_resolved_listener(iface_name, props_changed, props_removed):
+            if iface_name == DEVICE_IFACE and "ServicesResolved" in props_changed and props_changed["ServicesResolved"].value:
+                if not services_resolved.done():
+                    services_resolved.set_result(True)
+
+        self.properties_interface.on_properties_changed(_services_resolved_listener)
+        try:
+            await self.device_interface.call_connect()
+            if not await self.device_interface.get_services_resolved():
+                await services_resolved
+        finally:
+            self.properties_interface.off_properties_changed(_services_resolved_listener)
+
+        paths = self.object_tree.characteristics(self.path)
+        if paths == self.characteristic_paths:
+            # BlueZ exported the same GATT database again, the proxies and notify handlers still work
+            return
+
+        proxies = await asyncio.gather(*[self.proxy_factory.get_proxy_object(BLUEZ_BUS_NAME, path) for path in paths.values()])
+
+        # the handlers listen on the old characteristics, they have to be added again
+        for uuid, notify_handler in self.handlers.items():
+            self.characteristics[uuid].get_interface(PROPERTIES_IFACE).off_properties_changed(notify_handler)
+        self.handlers.clear()
+
+        self.characteristic_paths = paths
+        self.characteristics = dict(zip(paths.keys(), proxies))
+
+    async def disconnect(self):
+        await self.device_interface.call_disconnect()
+
+    async def wait_disconnected(self):
+        """
+        returns once BlueZ reports the device disconnected
+        """
+        disconnected = asyncio.get_running_loop().create_future()
+
+        def _connected_listener(iface_name, props_changed, props_removed):
+            if iface_name == DEVICE_IFACE and "Connected" in props_changed and not props_changed["Connected"].value:
+                if not disconnected.done():
+                    disconnected.set_result(True)
+
+        self.properties_interface.on_properties_changed(_connected_listener)
+        try:
+            if await self.device_interface.get_connected():
+                await disconnected
+        finally:
+            self.properties_interface.off_properties_changed(_connected_listener)
+
+    def is_subscribed(self, uuid):
+        return uuid.casefold() in self.handlers
+
+    async def read(self, uuid):
+        return await self._characteristic(uuid).get_interface(CHARACTERISTIC_IFACE).call_read_value({})
+
+    async def write(self, uuid, value, without_response=False):
+        options = {'type': Variant('s', 'command')} if without_response else {}
+        await self._characteristic(uuid).get_interface(CHARACTERISTIC_IFACE).call_write_value(value, options)
+
+    async def flags(self, uuid):
+        return await self._characteristic(uuid).get_interface(CHARACTERISTIC_IFACE).get_flags()
+
+    def char_write(self, uuid, value, without_response=False, error_callback=None):
+        """
+        starts a write without waiting for it, for callers that aren't coroutines like WaterBottle.
+        A failed write is printed, and passed to error_callback(error) if there is one.
+        """
+        task = asyncio.ensure_future(self.write(uuid, value, without_response))
+        # keep a reference until it's done, the loop only keeps weak ones
+        self._writes.add(task)
+        task.add_done_callback(lambda task: self._write_done(task, error_callback))
+
+    async def start_notify(self, uuid, handler):
+        characteristic = self._characteristic(uuid)
+        characteristic_interface = characteristic.get_interface(CHARACTERISTIC_IFACE)
+
+        flags = await characteristic_interface.get_flags()
+        if "notify" not in flags and "indicate" not in flags:
+            raise NotImplementedError(f"Notifications not implemented on {uuid}")
+
+        notify_handler = CharacteristicNotifyHandler(handler)
+        characteristic.get_interface(PROPERTIES_IFACE).on_properties_changed(notify_handler)
+        self.handlers[uuid.casefold()] = notify_handler
+
+        try:
+            await characteristic_interface.call_start_notify()
+        except Exception:
+            characteristic.get_interface(PROPERTIES_IFACE).off_properties_changed(notify_handler)
+            del self.handlers[uuid.casefold()]
+            raise
+
+    async def resume_notify(self, uuid):
+        """
+        turns notifications back on after a reconnect, the handler from start_notify is still listening
+        """
+        await self._characteristic(uuid).get_interface(CHARACTERISTIC_IFACE).call_start_notify()
+
+    async def stop_notify(self, uuid):
+        notify_handler = self.handlers.pop(uuid.casefold(), None)
+        if notify_handler is None:
+            return
+
+        characteristic = self._characteristic(uuid)
+        characteristic.get_interface(PROPERTIES_IFACE).off_properties_changed(notify_handler)
+        try:
+            await characteristic.get_interface(CHARACTERISTIC_IFACE).call_stop_notify()
+        except Exception:
+            pass
+
+    def _characteristic(self, uuid):
+        if uuid.casefold() not in self.characteristics:
+            raise KeyError(f"UUID {uuid} not found")
+
+        return self.characteristics[uuid.casefold()]
+
+    def _write_done(self, task, error_callback):
+        self._writes.discard(task)
+        if not task.cancelled() and task.exception():
+            traceback.print_exception(task.exception())
+            if error_callback:
+                error_callback(task.exception())
+
+
+class AioWaterBottle(WaterBottle):
+    """
+    WaterBottle on an AioBtleDevice, the sip protocol itself is unchanged
+    """
+
+    async def connect(self):
+        await self.device.connect()
+        if self.sips_characteristic_flags is None:
+            self.set_sips_characteristic_flags(await self.device.flags(self.SIPS_CHARACTERISTIC_UUID))
+
+        if self.device.is_subscribed(self.SIPS_CHARACTERISTIC_UUID):
+            await self.device.resume_notify(self.SIPS_CHARACTERISTIC_UUID)
+        else:
+            await self.device.start_notify(self.SIPS_CHARACTERISTIC_UUID, self.sips_notification_handler)
+
+        value = await self.device.read(self.SIPS_CHARACTERISTIC_UUID)
+        self.sips_notification_handler(value)
+
+    async def aclose(self):
+        # whatever was drained before the bottle went away still needs saving
+        self.finish_backlog_drain()
+        try:
+            await self.device.stop_notify(self.SIPS_CHARACTERISTIC_UUID)
+        finally:
+            await self.device.disconnect()
+
+    def cleanup(self):
+        asyncio.ensure_future(self.aclose())
+
+
+class AioBluetoothScanner:
+
+    def __init__(self, status_callback, devices_callback, sips_callback, journal: SipJournal | None = None,
+                 registry: DeviceRegistry | None = None, bus_address: str | None = None) -> None:
+        self.sip_stream = SipStream(sips_callback, journal)
+        self.devices = {}
+        self.bus_address = bus_address or os.environ.get(BUS_ADDRESS_ENV)
+        # every bottle seen, kept when BlueZ forgets the device so it can pick up where it left off
+        self.bottles = {}
+        self.connect_latencies = {}
+        # seconds the latest reconnect of each bottle took, from the disconnect
+        self.reconnect_latencies = {}
+        self.connected_paths = set()
+
+        self.registry = registry or DeviceRegistry()
+        self.discovery = DiscoveryPolicy(self._set_discovering)
+        self.status_callback = status_callback
+        self.devices_callback = devices_callback
+
+        self.object_tree = BluezObjectTree()
+        self.system_bus = None
+        self.obj_manager = None
+        self.adapter = None
+        self.adapter_properties = None
+
+        self._connect_slots = asyncio.Semaphore(self.registry.max_concurrent_connects)
+        self._device_tasks = {}
+        self._scanner_task = None
+
+    def start_scanner(self):
+        """
+        tells the bluetooth adaptor to start discovering BTLE devices
+        and adds listeners for when new devices are found
+        """
+        if self._scanner_task is None or self._scanner_task.done():
+            self._scanner_task = asyncio.ensure_future(self._start())
+            self._scanner_task.add_done_callback(self._report_task_error)
+
+    def stop_scanner(self):
+        """
+        Stops the bluetooth adaptor finding new devices, removes device listeners
+        and cleans up any existing devices
+        """
+        return asyncio.ensure_future(self._stop())
+
+    def close(self, closed_callback=None):
+        """
+        stops the scanner, disconnects the bottles and then the bus. Returns a future for when that's done,
+        closed_callback() is called then too, whether or not everything closed cleanly.
+        """
+        async def _close():
+            await self._stop()
+            if self.system_bus:
+                self.system_bus.disconnect()
+
+        closed = asyncio.ensure_future(_close())
+        if closed_callback:
+            closed.add_done_callback(lambda _: closed_callback())
+
+        return closed
+
+    async def _start(self):
+        self._send_status_update(BluetoothStatus.CONNECTING)
+        try:
+            await self._connect_bus()
+        except Exception as e:
+            traceback.print_exception(e)
+            self._send_status_update(BluetoothStatus.ERROR, BluetoothNotSupported("Unable to initialize Bluetooth scanning"))
+            return
+
+        self.obj_manager.on_interfaces_added(self._interfaces_added_signal)
+        self.obj_manager.on_interfaces_removed(self._interfaces_removed_signal)
+        self.adapter_properties.on_properties_changed(self._adapter_properties_listener)
+
+        if await self.adapter.get_powered():
+            self.discovery.start()
+            self._send_status_update(BluetoothStatus.ENABLED)
+            for path in self.object_tree.with_interface(DEVICE_IFACE):
+                self._interface_added_listener(path, self.object_tree.objects[path])
+        else:
+            self._send_status_update(BluetoothStatus.DISABLED)
+
+    async def _connect_bus(self):
+        if self.system_bus is not None:
+            return
+
+        # sometimes when the app is closed and then immediately restarted
+        # bluez or DBus just disconnects immediately when we try to read out
+        # the bluez objects. Retrying after a short, growing wait seems to address that.
+        for attempt in range(1, CONNECT_ATTEMPTS + 1):
+            bus = None
+            try:
+                bus = await MessageBus(bus_address=self.bus_address, bus_type=BusType.SYSTEM).connect()
+                startup_trace.mark('bus connected')
+                bluez = bus.get_proxy_object(BLUEZ_BUS_NAME, '/', await bus.introspect(BLUEZ_BUS_NAME, '/'))
+                obj_manager = bluez.get_interface(OBJ_MANAGER_IFACE)
+                # subscribe first so nothing that changes after the snapshot is missed
+                obj_manager.on_interfaces_added(self.object_tree.interfaces_added)
+                obj_manager.on_interfaces_removed(self.object_tree.interfaces_removed)
+                self.object_tree.load(await obj_manager.call_get_managed_objects())
+                startup_trace.mark('bluez objects loaded')
+                break
+            except Exception:
+                if bus is not None:
+                    bus.disconnect()
+                if attempt == CONNECT_ATTEMPTS:
+                    raise
+                metrics.BUS_CONNECT_RETRIES.inc()
+                await asyncio.sleep(connect_backoff_ms(attempt) / 1000)
+
+        adapter_paths = self.object_tree.with_interface(ADAPTER_IFACE)
+        if not adapter_paths:
+            raise BluetoothNotSupported("Could not find Bluetooth adapter")
+
+        self.system_bus = bus
+        self.obj_manager = obj_manager
+        self.discovery.stats.count_device_properties(bus)
+        self.proxy_factory = AioProxyFactory(bus, self.object_tree)
+        adapter_proxy = await self.proxy_factory.get_proxy_object(BLUEZ_BUS_NAME, adapter_paths[0])
+        self.adapter = adapter_proxy.get_interface(ADAPTER_IFACE)
+        self.adapter_properties = adapter_proxy.get_interface(PROPERTIES_IFACE)
+
+    async def _stop(self):
+        if self._scanner_task and not self._scanner_task.done():
+            self._scanner_task.cancel()
+
+        tasks = list(self._device_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await asyncio.gather(*[device.aclose() for device in self.devices.values()], return_exceptions=True)
+        self.devices.clear()
+        self.connected_paths.clear()
+
+        if self.obj_manager:
+            self.obj_manager.off_interfaces_added(self._interfaces_added_signal)
+            self.obj_manager.off_interfaces_removed(self._interfaces_removed_signal)
+            self.adapter_properties.off_properties_changed(self._adapter_properties_listener)
+            self.discovery.stop()
+            print(self.discovery.stats.summary())
+            try:
+                await self.adapter.call_stop_discovery()
+            except Exception:
+                pass
+
+        self._send_status_update(BluetoothStatus.DISABLED)
+
+    def _interfaces_added_signal(self, path, interfaces):
+        self.discovery.stats.count_signal('InterfacesAdded')
+        self._interface_added_listener(path, interfaces)
+
+    def _interfaces_removed_signal(self, path, interfaces):
+        self.discovery.stats.count_signal('InterfacesRemoved')
+        self._interface_removed_listener(path, interfaces)
+
+    def _interface_added_listener(self, path, interfaces):
+        if DEVICE_IFACE in interfaces.keys() and path not in self._device_tasks and path not in self.devices \
+                and self.registry.is_bottle(interfaces[DEVICE_IFACE]):
+            name = interfaces[DEVICE_IFACE].get('Alias', interfaces[DEVICE_IFACE].get('Address')).value
+            codec = codec_for(self.registry.model_for(interfaces[DEVICE_IFACE]))
+            task = asyncio.ensure_future(self._run_bottle(path, name, codec))
+            task.add_done_callback(lambda task: self._bottle_task_done(path, task))
+            self._device_tasks[path] = task
+
+    def _interface_removed_listener(self, path, interfaces):
+        if DEVICE_IFACE in interfaces:
+            task = self._device_tasks.pop(path, None)
+            if task:
+                task.cancel()
+
+            bottle = self.devices.pop(path, None)
+            if bottle:
+                bottle.disconnected()
+                self._send_devices_update()
+
+            self.connected_paths.discard(path)
+            self._update_bottles_present()
+
+    def _adapter_properties_listener(self, iface_name, props_changed, props_removed):
+        self.discovery.stats.count_signal('Adapter PropertiesChanged')
+        if iface_name == ADAPTER_IFACE and "Powered" in props_changed:
+            if props_changed["Powered"].value:
+                self.discovery.start()
+                self._send_status_update(BluetoothStatus.ENABLED)
+                self._send_devices_update()
+            else:
+                self.discovery.stop()
+                self._send_status_update(BluetoothStatus.DISABLED)
+
+    def _update_bottles_present(self):
+        connected = [self.object_tree.objects[path][DEVICE_IFACE] for path in self.connected_paths
+                     if DEVICE_IFACE in self.object_tree.objects.get(path, {})]
+        self.discovery.bottles_present(len(connected) == len(self.devices) and self.registry.all_present(connected))
+
+    def _set_discovering(self, discovering):
+        if discovering:
+            asyncio.ensure_future(self._start_adapter_discovering()).add_done_callback(self._report_task_error)
+        else:
+            # failing to stop only costs radio time, it isn't a scanner error
+            asyncio.ensure_future(self.adapter.call_stop_discovery()).add_done_callback(
+                lambda task: task.cancelled() or task.exception() and traceback.print_exception(task.exception()))
+
+    async def _start_adapter_discovering(self):
+        await self.adapter.call_set_discovery_filter(discovery_filter_variants(self.registry.discovery_filter()))
+        await self.adapter.call_start_discovery()
+
+    async def _run_bottle(self, path, name, codec):
+        bottle = self.bottles.get(path)
+        if bottle is None:
+            device_proxy = await self.proxy_factory.get_proxy_object(BLUEZ_BUS_NAME, path)
+            device_proxy.get_interface(PROPERTIES_IFACE).on_properties_changed(self.discovery.stats.count_bottle_properties)
+            bottle = AioWaterBottle(name, AioBtleDevice(path, device_proxy, self.object_tree, self.proxy_factory),
+                                    self.sip_stream, codec)
+            self.bottles[path] = bottle
+
+        self.devices[path] = bottle
+        self._send_devices_update()
+
+        attempts = 0
+        disconnected_at = None
+        while True:
+            try:
+                # BlueZ adapters only handle a few LE connection attempts at once
+                async with self._connect_slots:
+                    started = time.monotonic()
+                    await bottle.connect()
+                    self.connect_latencies[path] = time.monotonic() - started
+                    metrics.BOTTLE_CONNECT_SECONDS.observe(self.connect_latencies[path])
+            except Exception as e:
+                traceback.print_exception(e)
+                if isinstance(e, DBusError):
+                    metrics.DBUS_ERRORS.inc()
+
+                await asyncio.sleep(reconnect_delay_s(attempts))
+                attempts += 1
+                metrics.BOTTLE_CONNECT_RETRIES.inc()
+                continue
+
+            print(f"{bottle.name}: connected in {self.connect_latencies[path]:.2f}s")
+            if disconnected_at is not None:
+                self.reconnect_latencies[path] = time.monotonic() - disconnected_at
+                print(f"{bottle.name}: reconnected after {self.reconnect_latencies[path]:.1f}s")
+
+            attempts = 0
+            self.connected_paths.add(path)
+            self._update_bottles_present()
+
+            await bottle.device.wait_disconnected()
+            disconnected_at = time.monotonic()
+            bottle.disconnected()
+            self.connected_paths.discard(path)
+            self._update_bottles_present()
+
+            await asyncio.sleep(reconnect_delay_s(attempts))
+            attempts += 1
+            metrics.BOTTLE_CONNECT_RETRIES.inc()
+
+    def _bottle_task_done(self, path, task):
+        if self._device_tasks.get(path) is task:
+            del self._device_tasks[path]
+
+        # one bottle failing isn't a scanner error, it's tried again when it's rediscovered
+        if not task.cancelled() and task.exception():
+            traceback.print_exception(task.exception())
+            if self.devices.pop(path, None):
+                self._send_devices_update()
+                self._update_bottles_present()
+
+    def _report_task_error(self, task):
+        if not task.cancelled() and task.exception():
+            traceback.print_exception(task.exception())
+            self._send_status_update(BluetoothStatus.ERROR, task.exception())
+
+    def _send_status_update(self, status: BluetoothStatus, data: Any = None):
+        def _idle_callback():
+            self.status_callback(status, data)
+            return False
+
+        GLib.idle_add(_idle_callback)
+
+    def _send_devices_update(self):
+        GLib.idle_add(self.devices_callback, self.devices)
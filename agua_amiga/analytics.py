@@ -0,0 +1,85 @@
+"""
+aggregates over the whole drinks history with numpy.
+
+Drinks are read in one query into columns (see DrinkColumns), after that every
+aggregate is a handful of array operations instead of a loop over rows.
+numpy isn't needed by the rest of the app, it comes with the analytics extra
+(pip install agua_amiga[analytics]) and nothing outside this module imports it.
+"""
+from typing import List, NamedTuple
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("agua_amiga.analytics needs numpy, install agua_amiga with the analytics extra") from e
+
+from agua_amiga.datastore import Datastore
+
+SECONDS_IN_HOUR = 3600
+SECONDS_IN_DAY = 86400
+
+
+class DrinkColumns(NamedTuple):
+    timestamps: np.ndarray      # float64 unix timestamps
+    local_times: np.ndarray     # float64 local wall clock seconds since 1970-01-01
+    volumes: np.ndarray         # float32 mL
+    source_codes: np.ndarray    # int32 index into sources
+    sources: List[str]
+
+
+def load_drinks(datastore: Datastore, date_range_start=None, date_range_end=None) -> DrinkColumns:
+    timestamps, local_times, volumes, sources = datastore.get_drink_columns(date_range_start, date_range_end)
+    source_names, source_codes = np.unique(np.array(sources, dtype=object).astype(str), return_inverse=True)
+
+    return DrinkColumns(
+        np.array(timestamps, dtype=np.float64),
+        np.array(local_times, dtype=np.float64),
+        np.array(volumes, dtype=np.float32),
+        source_codes.astype(np.int32),
+        source_names.tolist(),
+    )
+
+
+def hourly_histogram(drinks: DrinkColumns) -> np.ndarray:
+    """
+    total mL drunk in each local hour of the day, index 0 is midnight to 1am
+    """
+    hours = (drinks.local_times // SECONDS_IN_HOUR).astype(np.int64) % 24
+    return np.bincount(hours, weights=drinks.volumes, minlength=24)
+
+
+def daily_totals(drinks: DrinkColumns):
+    """
+    returns (days, totals): every local day from the first drink to the last as datetime64[D],
+    and mL drunk on each, days without drinks are 0
+    """
+    if len(drinks.local_times) == 0:
+        return np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64)
+
+    day_numbers = (drinks.local_times // SECONDS_IN_DAY).astype(np.int64)
+    first_day = day_numbers.min()
+    totals = np.bincount(day_numbers - first_day, weights=drinks.volumes)
+    days = np.arange(first_day, first_day + len(totals)).astype('datetime64[D]')
+
+    return days, totals
+
+
+def rolling_average(drinks: DrinkColumns, window_days=7):
+    """
+    returns (days, averages) where each average covers the window_days ending on that day.
+    Days before a full window is available are averaged over the days there are.
+    """
+    days, totals = daily_totals(drinks)
+    sums = np.cumsum(totals)
+    sums[window_days:] = sums[window_days:] - sums[:-window_days]
+    counts = np.minimum(np.arange(1, len(totals) + 1), window_days)
+
+    return days, sums / counts
+
+
+def per_source_totals(drinks: DrinkColumns):
+    """
+    returns {source: total mL}
+    """
+    totals = np.bincount(drinks.source_codes, weights=drinks.volumes, minlength=len(drinks.sources))
+    return dict(zip(drinks.sources, totals.tolist()))
@@ -1,9 +1,11 @@
 from datetime import timedelta, datetime
-from collections import deque, defaultdict
+import bisect
+import os
+from collections import Counter, deque, defaultdict
 from sqlite3.dbapi2 import adapters
 import time
 import enum
-from typing import Any, cast
+from typing import Any, NamedTuple, cast
 from dbus_next.glib import MessageBus
 from dbus_next import BusType, Variant, introspection
 from promise import Promise
@@ -11,6 +13,13 @@ import traceback
 
 from gi.repository import GLib, Gio
 
+from agua_amiga import metrics, startup_trace
+from agua_amiga.bottle_codecs import codec_for
+from agua_amiga.connection_manager import ConnectionManager
+from agua_amiga.device_registry import DeviceRegistry
+from agua_amiga.discovery import DiscoveryPolicy
+from agua_amiga.sip_journal import SipJournal
+
 BLUEZ_BUS_NAME = 'org.bluez'
 
 ADAPTER_IFACE = 'org.bluez.Adapter1'
@@ -24,12 +33,46 @@ class BluetoothStatus(enum.Enum):
     ENABLED = 1
     DISABLED = 2
     ERROR = 3
+    CONNECTING = 4
+
+
+# points the scanners at another bus than the system bus, e.g. the one benchmarks/fake_bluez.py runs on
+BUS_ADDRESS_ENV = 'AGUA_AMIGA_BUS_ADDRESS'
+
+# connecting to the system bus is retried this many times, waiting CONNECT_BACKOFF_MS, then twice that, ...
+CONNECT_ATTEMPTS = 5
+CONNECT_BACKOFF_MS = 250
+
+
+# a backlog drain is given up on when the bottle sends no stored sip for this long, e.g. because an ACK was lost
+BACKLOG_STALL_TIMEOUT_S = 5
+
+
+def connect_backoff_ms(attempt):
+    return CONNECT_BACKOFF_MS * 2 ** (attempt - 1)
+
+
+DISCOVERY_FILTER_SIGNATURES = {'Transport': 's', 'UUIDs': 'as', 'RSSI': 'n', 'DuplicateData': 'b'}
+
+
+def discovery_filter_variants(discovery_filter):
+    """
+    wraps DeviceRegistry.discovery_filter's values for SetDiscoveryFilter
+    """
+    return {name: Variant(DISCOVERY_FILTER_SIGNATURES[name], value) for name, value in discovery_filter.items()}
 
 
 def dbus_callback_promise(method, *args):
+    started = time.perf_counter() if metrics.ENABLED else None
+
     def resolver(resolve, reject):
 
         def callback(result, error=None):
+            if started is not None:
+                metrics.DBUS_CALL_SECONDS.observe_since(started)
+                if isinstance(error, Exception):
+                    metrics.DBUS_ERRORS.inc()
+
             if isinstance(error, Exception):
                 reject(error)
             else:
@@ -40,51 +83,316 @@ def dbus_callback_promise(method, *args):
     return Promise(resolver)
 
 
+def timeout_promise(delay_ms):
+    """
+    a Promise that resolves after delay_ms on the main loop
+    """
+    def resolver(resolve, reject):
+        def _timeout():
+            resolve(None)
+            return False
+
+        GLib.timeout_add(delay_ms, _timeout)
+
+    return Promise(resolver)
+
+
 class BluetoothNotSupported(Exception):
     pass
 
 
+class SipStream(deque):
+    """
+    a deque of (volume, time, source) sips that calls back into the main loop when sips are added.
+    Sips that arrive close together are coalesced into a single callback, so a burst of sips
+    is flushed once. Nothing is scheduled while the stream is idle.
+    With a journal, sips are written to it before they are queued.
+    Sips from a held source don't schedule the callback, see hold.
+    """
+
+    def __init__(self, callback, journal: SipJournal | None = None, quiet_ms=200, max_delay_ms=1000) -> None:
+        super().__init__()
+        self.callback = callback
+        self.journal = journal
+        self.quiet_ms = quiet_ms
+        self.max_delay_ms = max_delay_ms
+        self._timeout_id = None
+        self._burst_started = None
+        # holds per sip source, bottles of one model can share a name
+        self._holds = Counter()
+        # when each queued sip was added, oldest on the right like the sips, only kept with metrics on
+        self.queued_at = deque()
+
+    def hold(self, source):
+        """
+        sips from source are queued (and journaled) without scheduling the callback until release(source),
+        so a bottle's backlog is flushed as one batch. Other sources are flushed as usual, and take
+        whatever was held so far with them.
+        """
+        self._holds[source] += 1
+
+    def release(self, source):
+        self._holds[source] -= 1
+        if self._holds[source] <= 0:
+            del self._holds[source]
+
+        if len(self):
+            self._schedule_callback()
+
+    def appendleft(self, sip):
+        if self.journal:
+            self.journal.append(*sip)
+
+        super().appendleft(sip)
+        if metrics.ENABLED:
+            self.queued_at.appendleft(time.perf_counter())
+
+        if sip[2] not in self._holds:
+            self._schedule_callback()
+
+    def extendleft(self, sips):
+        sips = list(sips)
+        if self.journal:
+            for sip in sips:
+                self.journal.append(*sip)
+
+        super().extendleft(sips)
+        if metrics.ENABLED:
+            self.queued_at.extendleft([time.perf_counter()] * len(sips))
+
+        if any(source not in self._holds for _, _, source in sips):
+            self._schedule_callback()
+
+    def take_queued_at(self, count):
+        """
+        removes and returns when the count oldest sips were queued, after they were popped
+        """
+        return [self.queued_at.pop() for _ in range(min(count, len(self.queued_at)))]
+
+    def _schedule_callback(self):
+        now = time.monotonic()
+        if self._timeout_id is None:
+            self._burst_started = now
+        else:
+            GLib.source_remove(self._timeout_id)
+
+        # wait for the burst to go quiet, but don't hold sips back longer than max_delay_ms
+        waited_ms = (now - self._burst_started) * 1000
+        delay_ms = int(max(0, min(self.quiet_ms, self.max_delay_ms - waited_ms)))
+        self._timeout_id = GLib.timeout_add(delay_ms, self._run_callback)
+
+    def _run_callback(self):
+        self._timeout_id = None
+        self._burst_started = None
+        self.callback()
+        return False
+
+
+class BluezObjectTree:
+    """
+    a local copy of the objects BlueZ exports, read once with GetManagedObjects and then kept
+    current from the ObjectManager's InterfacesAdded and InterfacesRemoved signals.
+    Objects can be looked up by interface or by path prefix without going over the bus.
+    """
+
+    def __init__(self) -> None:
+        self.objects = {}
+        self._paths = []
+        self._by_interface = defaultdict(set)
+
+    def load(self, managed_objects):
+        self.objects = {}
+        self._paths = []
+        self._by_interface = defaultdict(set)
+
+        for path, interfaces in managed_objects.items():
+            self.interfaces_added(path, interfaces)
+
+        return self
+
+    def interfaces_added(self, path, interfaces):
+        if path not in self.objects:
+            self.objects[path] = {}
+            bisect.insort(self._paths, path)
+
+        self.objects[path].update(interfaces)
+        for interface in interfaces:
+            self._by_interface[interface].add(path)
+
+    def interfaces_removed(self, path, interfaces):
+        if path not in self.objects:
+            return
+
+        for interface in interfaces:
+            self.objects[path].pop(interface, None)
+            self._by_interface[interface].discard(path)
+
+        if not self.objects[path]:
+            del self.objects[path]
+            del self._paths[bisect.bisect_left(self._paths, path)]
+
+    def with_interface(self, interface):
+        """
+        returns the paths of objects that implement interface
+        """
+        return sorted(self._by_interface[interface])
+
+    def descendants(self, path):
+        """
+        returns the paths of objects below path, e.g. the services and characteristics of a device
+        """
+        prefix = path.rstrip('/') + '/'
+        start = bisect.bisect_left(self._paths, prefix)
+        end = bisect.bisect_left(self._paths, prefix[:-1] + chr(ord('/') + 1))
+
+        return self._paths[start:end]
+
+    def characteristics(self, device_path):
+        """
+        returns {uuid: path} for the GATT characteristics of a device
+        """
+        characteristics = {}
+        for path in self.descendants(device_path):
+            characteristic_uuid = self.objects[path].get(CHARACTERISTIC_IFACE, {}).get('UUID')
+            if characteristic_uuid:
+                characteristics[characteristic_uuid.value] = path
+
+        return characteristics
+
+
+class ProxyFactory:
+    """
+    builds proxy objects without an Introspect call per object. Every bottle and every characteristic
+    of a kind exports the same interfaces, so introspection data is cached by the set of interfaces
+    the object tree says an object has and reused for every object with that set.
+    Proxies are reused per path as long as the object's interfaces stay the same.
+    """
+
+    def __init__(self, bus, object_tree: BluezObjectTree) -> None:
+        self.bus = bus
+        self.object_tree = object_tree
+        self._introspections = {}
+        self._proxies = {}
+
+    def get_proxy_object(self, bus_name, path):
+        interfaces = self.object_tree.objects.get(path)
+        signature = (bus_name, frozenset(interfaces)) if interfaces else None
+
+        key = (bus_name, path, signature)
+        if key not in self._proxies:
+            if signature is None:
+                # not in the tree (yet), so nothing is known about its shape
+                introspection_promise = dbus_callback_promise(self.bus.introspect, bus_name, path)
+            else:
+                if signature not in self._introspections:
+                    self._introspections[signature] = dbus_callback_promise(self.bus.introspect, bus_name, path)
+
+                introspection_promise = self._introspections[signature]
+
+            self._proxies[key] = introspection_promise.then(
+                lambda introspection: self.bus.get_proxy_object(bus_name, path, introspection))
+
+            # don't keep failures around, the next call should try again
+            self._proxies[key].catch(lambda _: self._forget(key, signature))
+
+        return self._proxies[key]
+
+    def _forget(self, key, signature):
+        self._proxies.pop(key, None)
+        self._introspections.pop(signature, None)
+
+
 class BluetoothScanner:
 
-    def __init__(self, status_callback, devices_callback) -> None:
-        self.sip_stream = deque()
+    def __init__(self, status_callback, devices_callback, sips_callback, journal: SipJournal | None = None,
+                 registry: DeviceRegistry | None = None, bus_address: str | None = None) -> None:
+        """
+        bus_address is the D-Bus address BlueZ is found on, the system bus unless it or AGUA_AMIGA_BUS_ADDRESS is set
+        """
+        self.sip_stream = SipStream(sips_callback, journal)
         self.devices = {}
+        self.bus_address = bus_address or os.environ.get(BUS_ADDRESS_ENV)
+
+        self.registry = registry or DeviceRegistry()
+        # bottles are kept by the manager across disconnects, self.devices only has the ones BlueZ currently knows about
+        self.connection_manager = ConnectionManager(self._bottle_connection_changed, self.registry.max_concurrent_connects)
+        self.connection_scheduler = self.connection_manager.scheduler
+        self.connected_paths = set()
+        self.discovery = DiscoveryPolicy(self._set_discovering)
 
         self.status_callback = status_callback
         self.devices_callback = devices_callback
 
         self.traceback_printer = traceback_printer(self.__class__.__name__)
+        self.object_tree = BluezObjectTree()
 
-        # sometimes when the app is closed and then immediately restarted
-        # bluez or DBus just disconnects immediately when we try to read out
-        # the bluez objects. A retry after a short wait seems to address that.
-        for attempt in range(1, 4):
-            try:
-
-                self.system_bus = MessageBus(bus_type=BusType.SYSTEM).connect_sync()
-                self.bluez_promise = self._get_dbus_proxy_object(BLUEZ_BUS_NAME, '/')
+        # connecting happens on the main loop, nothing here waits on D-Bus
+        self.system_bus = None
+        self.proxy_factory = None
+        self.object_tree_promise = self._connect_bus()
+        self.bluez_promise = self.object_tree_promise.then(lambda _: self._get_dbus_proxy_object(BLUEZ_BUS_NAME, '/'))
 
-                def get_bluez_child_objects(bluez):
-                    obj_manager = bluez.get_interface(OBJ_MANAGER_IFACE)
-                    return dbus_callback_promise(obj_manager.call_get_managed_objects) \
-                        .then(lambda children: children[0])
+        def find_adapter(object_tree):
+            for path in object_tree.with_interface(ADAPTER_IFACE):
+                return self._get_dbus_proxy_object(BLUEZ_BUS_NAME, path)
 
-                def find_adapter(children):
-                    for path, child in children.items():
-                        if ADAPTER_IFACE in child.keys():
-                            return self._get_dbus_proxy_object(BLUEZ_BUS_NAME, path)
+            return Promise.reject(BluetoothNotSupported("Could not find Bluetooth adapter"))
 
-                    return Promise.reject(BluetoothNotSupported("Could not find Bluetooth adapter"))
+        self.adapter_promise = self.object_tree_promise.then(find_adapter, self._promise_error_handler)
+        self._send_status_update(BluetoothStatus.CONNECTING)
 
-                self.adapter_promise = self.bluez_promise.then(get_bluez_child_objects) \
-                    .then(find_adapter, self._promise_error_handler)
+    def _connect_bus(self, attempt=1):
+        """
+        connects to the system bus and loads the bluez objects, returns a Promise for the object tree
+        """
+        # this attempt's bus, so retry can close it even if connecting failed before it became system_bus
+        attempt_bus = None
+
+        def load_object_tree(bus):
+            startup_trace.mark('bus connected')
+            self.system_bus = bus
+            self.proxy_factory = ProxyFactory(bus, self.object_tree)
+            self.discovery.stats.count_device_properties(bus)
+            return self._get_dbus_proxy_object(BLUEZ_BUS_NAME, '/').then(subscribe_and_read)
+
+        def subscribe_and_read(bluez):
+            # subscribe first so nothing that changes after the snapshot is missed
+            obj_manager = bluez.get_interface(OBJ_MANAGER_IFACE)
+            obj_manager.on_interfaces_added(self.object_tree.interfaces_added)
+            obj_manager.on_interfaces_removed(self.object_tree.interfaces_removed)
+            return dbus_callback_promise(obj_manager.call_get_managed_objects) \
+                .then(lambda children: self.object_tree.load(children[0]))
+
+        def loaded(object_tree):
+            startup_trace.mark('bluez objects loaded')
+            return object_tree
 
-            except Exception as e:
-                if attempt < 3:
-                    time.sleep(0.5)
-                else:
-                    self._send_status_update(BluetoothStatus.ERROR, BluetoothNotSupported(
-                        "Unable to initialize Bluetooth scanning"))
+        # sometimes when the app is closed and then immediately restarted
+        # bluez or DBus just disconnects immediately when we try to read out
+        # the bluez objects. Retrying after a short, growing wait seems to address that.
+        def retry(error):
+            if attempt_bus is not None:
+                attempt_bus.disconnect()
+            self.system_bus = None
+
+            if attempt == CONNECT_ATTEMPTS:
+                traceback_printer("connect to system bus")(error)
+                return Promise.reject(BluetoothNotSupported("Unable to initialize Bluetooth scanning"))
+
+            metrics.BUS_CONNECT_RETRIES.inc()
+            return timeout_promise(connect_backoff_ms(attempt)).then(lambda _: self._connect_bus(attempt + 1))
+
+        def create_bus(resolve, reject):
+            nonlocal attempt_bus
+            # MessageBus opens the bus socket right away and raises if it can't, inside the executor
+            # that rejects the Promise, so it's retried like any other failure
+            attempt_bus = MessageBus(bus_address=self.bus_address, bus_type=BusType.SYSTEM)
+            resolve(attempt_bus)
+
+        return Promise(create_bus) \
+            .then(lambda bus: dbus_callback_promise(bus.connect)) \
+            .then(load_object_tree) \
+            .then(loaded, retry)
 
     def start_scanner(self):
         """
@@ -93,8 +401,8 @@ class BluetoothScanner:
         """
 
         def _start(obj_manager, adapter_proxy):
-            obj_manager.on_interfaces_added(self._interface_added_listener)
-            obj_manager.on_interfaces_removed(self._interface_removed_listener)
+            obj_manager.on_interfaces_added(self._interfaces_added_signal)
+            obj_manager.on_interfaces_removed(self._interfaces_removed_signal)
             adapter = adapter_proxy.get_interface(ADAPTER_IFACE)
             adapter_properties = adapter_proxy.get_interface(PROPERTIES_IFACE)
 
@@ -102,7 +410,8 @@ class BluetoothScanner:
 
             def _check_powered_on(powered):
                 if powered:
-                    self._start_adapter_discovering().catch(traceback_printer("start scanner check powered on"))
+                    self.discovery.start()
+                    self.connection_manager.start()
                     self._get_discovered_devices()
                     self._send_status_update(BluetoothStatus.ENABLED)
                 else:
@@ -123,71 +432,143 @@ class BluetoothScanner:
         """
         def _stop(obj_manager, adapter_proxy):
 
-            obj_manager.off_interfaces_added(self._interface_added_listener)
-            obj_manager.off_interfaces_removed(self._interface_removed_listener)
+            obj_manager.off_interfaces_added(self._interfaces_added_signal)
+            obj_manager.off_interfaces_removed(self._interfaces_removed_signal)
 
-            for device in self.devices.values():
-                device.cleanup()
+            # the bottles are disconnected on purpose, they shouldn't be reconnected
+            self.connection_manager.stop()
+            cleanups = [device.cleanup() for device in self.devices.values()]
 
             adapter = adapter_proxy.get_interface(ADAPTER_IFACE)
             adapter_properties = adapter_proxy.get_interface(PROPERTIES_IFACE)
 
             adapter_properties.off_properties_changed(self._adapter_properties_listener)
-            dbus_callback_promise(adapter.call_stop_discovery)
+            self.discovery.stop()
+            print(self.discovery.stats.summary())
 
             self._send_status_update(BluetoothStatus.DISABLED)
 
+            return Promise.all(cleanups + [
+                dbus_callback_promise(adapter.call_stop_discovery).catch(traceback_printer("stop discovery"))
+            ])
+
         return Promise.all([
             self._obj_manager_promise(),
             self.adapter_promise
         ]).then(lambda args: _stop(*args), self._promise_error_handler)
 
-    def close(self):
-        self.stop_scanner().then(lambda _: dbus_callback_promise(self.system_bus.disconnect))
+    def close(self, closed_callback=None):
+        """
+        stops the scanner, disconnects the bottles and then the bus. Returns a Promise for when that's done,
+        closed_callback() is called then too, whether or not everything closed cleanly.
+        """
+        def _stop_object_tree_updates(obj_manager):
+            obj_manager.off_interfaces_added(self.object_tree.interfaces_added)
+            obj_manager.off_interfaces_removed(self.object_tree.interfaces_removed)
+
+        def _disconnect_bus(_):
+            if self.system_bus:
+                self.system_bus.disconnect()
+
+        closed = self.stop_scanner() \
+            .then(lambda _: self._obj_manager_promise()) \
+            .then(_stop_object_tree_updates) \
+            .then(_disconnect_bus)
+
+        if closed_callback:
+            closed.then(lambda _: closed_callback(), lambda _: closed_callback())
+
+        return closed
+
+    def _interfaces_added_signal(self, path, interfaces):
+        self.discovery.stats.count_signal('InterfacesAdded')
+        self._interface_added_listener(path, interfaces)
+
+    def _interfaces_removed_signal(self, path, interfaces):
+        self.discovery.stats.count_signal('InterfacesRemoved')
+        self._interface_removed_listener(path, interfaces)
 
     def _interface_added_listener(self, path, interfaces):
-        if DEVICE_IFACE in interfaces.keys() and not interfaces[DEVICE_IFACE]['Blocked'].value and interfaces[DEVICE_IFACE]['Alias'].value in ['h2o10C28']:
-            def create_water_bottle_and_notify(device, obj_manager):
-                self.devices[path] = WaterBottle(interfaces[DEVICE_IFACE]['Alias'].value,
-                                                 BtleDevice(path, device, obj_manager), self.sip_stream)
-                self._send_devices_update()
+        if DEVICE_IFACE in interfaces.keys() and path not in self.devices and self.registry.is_bottle(interfaces[DEVICE_IFACE]):
+            name = interfaces[DEVICE_IFACE].get('Alias', interfaces[DEVICE_IFACE].get('Address')).value
+            codec = codec_for(self.registry.model_for(interfaces[DEVICE_IFACE]))
+
+            def create_water_bottle_and_notify(device):
+                device.get_interface(PROPERTIES_IFACE).on_properties_changed(self.discovery.stats.count_bottle_properties)
+                bottle = WaterBottle(name, BtleDevice(path, device, self.object_tree, self.proxy_factory), self.sip_stream, codec)
+                self._add_bottle(path, bottle)
+
+            known = self.connection_manager.connections.get(path)
+            if known:
+                # BlueZ forgot the device and found it again, the bottle from before picks up where it left off
+                self._add_bottle(path, known.bottle)
+            else:
+                self._get_dbus_proxy_object(BLUEZ_BUS_NAME, path) \
+                    .then(create_water_bottle_and_notify, self._promise_error_handler)
 
-            Promise.all([self._get_dbus_proxy_object(BLUEZ_BUS_NAME, path),
-                         self._obj_manager_promise()]) \
-                .then(lambda args: create_water_bottle_and_notify(*args), self._promise_error_handler)
+    def _add_bottle(self, path, bottle):
+        self.devices[path] = self.connection_manager.add(path, bottle)
+        self._send_devices_update()
 
     def _interface_removed_listener(self, path, interfaces):
         if path in self.devices.keys() and DEVICE_IFACE in interfaces:
-            self.devices[path].cleanup()
             del self.devices[path]
+            self.connection_manager.device_removed(path)
+            self.connected_paths.discard(path)
+            self._update_bottles_present()
             GLib.idle_add(self.devices_callback, self.devices)
 
+    def _bottle_connection_changed(self, path, connected):
+        if connected and path in self.devices:
+            self.connected_paths.add(path)
+        else:
+            self.connected_paths.discard(path)
+
+        self._update_bottles_present()
+
+    def _update_bottles_present(self):
+        connected = [self.object_tree.objects[path][DEVICE_IFACE] for path in self.connected_paths
+                     if DEVICE_IFACE in self.object_tree.objects.get(path, {})]
+        self.discovery.bottles_present(len(connected) == len(self.devices) and self.registry.all_present(connected))
+
     def _adapter_properties_listener(self, iface_name, props_changed, props_removed):
+        self.discovery.stats.count_signal('Adapter PropertiesChanged')
         if iface_name == ADAPTER_IFACE and "Powered" in props_changed:
             if props_changed["Powered"].value:
-                self._start_adapter_discovering()
+                self.discovery.start()
+                self.connection_manager.start()
                 self._send_status_update(BluetoothStatus.ENABLED)
                 self._send_devices_update()
             else:
+                self.discovery.stop()
+                self.connection_manager.stop()
                 self._send_status_update(BluetoothStatus.DISABLED)
 
+    def _set_discovering(self, discovering):
+        if discovering:
+            self._start_adapter_discovering()
+        else:
+            self.adapter_promise.then(lambda adapter_proxy: adapter_proxy.get_interface(ADAPTER_IFACE)) \
+                .then(lambda adapter: dbus_callback_promise(adapter.call_stop_discovery)) \
+                .catch(traceback_printer("stop adapter discovering"))
+
     def _start_adapter_discovering(self):
+        discovery_filter = discovery_filter_variants(self.registry.discovery_filter())
+
         return self.adapter_promise.then(lambda adapter_proxy: adapter_proxy.get_interface(ADAPTER_IFACE)) \
-            .then(lambda adapter: dbus_callback_promise(adapter.call_set_discovery_filter, {'Transport': Variant('s', 'le')})
+            .then(lambda adapter: dbus_callback_promise(adapter.call_set_discovery_filter, discovery_filter)
                   .then(lambda _: dbus_callback_promise(adapter.call_start_discovery))) \
             .catch(traceback_printer("start adapter discovering")) \
             .catch(self._promise_error_handler)
 
     def _get_discovered_devices(self):
-        return self._obj_manager_promise().then(lambda obj_manager:
-                                                dbus_callback_promise(obj_manager.call_get_managed_objects)
-                                                .then(lambda children: children[0])
-                                                .then(
-                                                    lambda children: [self._interface_added_listener(path, child) for path, child in children.items()],
-                                                )).catch(traceback_printer("get discovered devices"))
+        return self.object_tree_promise.then(
+            lambda object_tree: [self._interface_added_listener(path, object_tree.objects[path])
+                                 for path in object_tree.with_interface(DEVICE_IFACE)]
+        ).catch(traceback_printer("get discovered devices"))
 
     def _get_dbus_proxy_object(self, bus_name, path):
-        return dbus_callback_promise(self.system_bus.introspect, bus_name, path).then(lambda introspection: self.system_bus.get_proxy_object(bus_name, path, introspection))
+        return self.proxy_factory.get_proxy_object(bus_name, path)
 
     def _promise_error_handler(self, error: Exception):
         traceback_printer("promise error handler")(error)
@@ -232,34 +613,32 @@ def traceback_printer(location):
 
 
 class BtleDevice:
-    def __init__(self, path, device_proxy, obj_manager) -> None:
+    def __init__(self, path, device_proxy, object_tree: BluezObjectTree, proxy_factory: ProxyFactory) -> None:
         self.path = path
         self.device_interface = device_proxy.get_interface(DEVICE_IFACE)
         self.properties_interface = device_proxy.get_interface(PROPERTIES_IFACE)
         self.system_bus = device_proxy.bus
-        self.obj_manager = obj_manager
+        self.object_tree = object_tree
+        self.proxy_factory = proxy_factory
         self.characteristics_promise = Promise.reject(Exception("Couldn't get device characteristics"))
+        # the characteristics found on the last connect and their paths, kept across reconnects
+        self.characteristics = None
+        self.characteristic_paths = None
         self.handlers = defaultdict(list)
         self.traceback_printer = traceback_printer(self.__class__.__name__)
+        self._services_resolved_listener = None
 
     def connect(self):
 
-        def _filter_characteristics(children):
-
-            promises = {}
-
-            for path, child in children.items():
-                characteristic_uuid = child.get(CHARACTERISTIC_IFACE, {}).get('UUID')
-
-                if path.startswith(self.path) and characteristic_uuid:
-                    promises[characteristic_uuid.value] = self._get_dbus_proxy_object(BLUEZ_BUS_NAME, path)
-
-            return Promise.for_dict(promises)
-
         def _get_characteristics():
-            return dbus_callback_promise(self.obj_manager.call_get_managed_objects) \
-                .then(lambda children: children[0]) \
-                .then(_filter_characteristics)
+            paths = self.object_tree.characteristics(self.path)
+            if self.characteristics is not None and paths == self.characteristic_paths:
+                # BlueZ exported the same GATT database again, the proxies and notify handlers still work
+                return Promise.resolve(self.characteristics)
+
+            return Promise.for_dict({characteristic_uuid: self._get_dbus_proxy_object(BLUEZ_BUS_NAME, path)
+                                     for characteristic_uuid, path in paths.items()}) \
+                .then(lambda characteristics: self._characteristics_found(paths, characteristics))
 
         def _get_now_or_later(services_resolved):
             if services_resolved:
@@ -271,11 +650,14 @@ class BtleDevice:
 
             def _collect_characteristics(iface_name, props_changed, props_removed):
                 if iface_name == DEVICE_IFACE and "ServicesResolved" in props_changed.keys() and props_changed["ServicesResolved"].value:
-                    self.properties_interface.off_properties_changed(_collect_characteristics)
+                    self._remove_services_resolved_listener()
                     _get_characteristics().then(resolve, reject)
 
+            self._services_resolved_listener = _collect_characteristics
             self.properties_interface.on_properties_changed(_collect_characteristics)
 
+        # a failed attempt can leave its listener behind
+        self._remove_services_resolved_listener()
         self.characteristics_promise = dbus_callback_promise(self.device_interface.get_services_resolved).then(
             _get_now_or_later).catch(self.traceback_printer)
         return dbus_callback_promise(self.device_interface.call_connect)
@@ -283,6 +665,19 @@ class BtleDevice:
     def disconnect(self):
         return dbus_callback_promise(self.device_interface.call_disconnect)
 
+    def on_connection_change(self, handler):
+        """
+        handler(connected) is called whenever BlueZ reports the device connecting or disconnecting
+        """
+        def _connected_listener(iface_name, props_changed, props_removed):
+            if iface_name == DEVICE_IFACE and "Connected" in props_changed:
+                handler(props_changed["Connected"].value)
+
+        self.properties_interface.on_properties_changed(_connected_listener)
+
+    def is_subscribed(self, uuid):
+        return uuid.casefold() in self.handlers
+
     def char_read(self, uuid):
         def _read_characteristic(characteristics):
             if uuid.casefold() in characteristics:
@@ -292,14 +687,35 @@ class BtleDevice:
 
         return self.characteristics_promise.then(_read_characteristic)
 
-    def char_write(self, uuid, value):
+    def char_write(self, uuid, value, without_response=False, error_callback=None):
+        """
+        without_response sends a write command, which BlueZ doesn't wait on the device to confirm.
+        A failed write is printed, and passed to error_callback(error) if there is one.
+        """
+        options = {'type': Variant('s', 'command')} if without_response else {}
+
         def _write_characteristic(characteristics):
             if uuid.casefold() in characteristics:
                 characteristic = characteristics[uuid.casefold()]
                 characteristic_interface = characteristic.get_interface(CHARACTERISTIC_IFACE)
-                return dbus_callback_promise(characteristic_interface.call_write_value, value, {})
+                return dbus_callback_promise(characteristic_interface.call_write_value, value, options)
+
+        def _write_failed(error):
+            self.traceback_printer(error)
+            if error_callback:
+                error_callback(error)
+
+        return self.characteristics_promise.then(_write_characteristic).catch(_write_failed)
+
+    def char_flags(self, uuid):
+        def _get_flags(characteristics):
+            if uuid.casefold() in characteristics:
+                characteristic_interface = characteristics[uuid.casefold()].get_interface(CHARACTERISTIC_IFACE)
+                return dbus_callback_promise(characteristic_interface.get_flags)
 
-        return self.characteristics_promise.then(_write_characteristic).catch(self.traceback_printer)
+            return []
+
+        return self.characteristics_promise.then(_get_flags)
 
     def on_value_change(self, uuid, handler):
         uuid = uuid.casefold()
@@ -329,6 +745,22 @@ class BtleDevice:
 
         return self.characteristics_promise.then(_add_notification).catch(self.traceback_printer)
 
+    def resume_notify(self, uuid):
+        """
+        turns notifications back on after a reconnect. The handlers added by on_value_change are still
+        listening, so only the bottle needs asking again.
+        """
+        uuid = uuid.casefold()
+
+        def _start_notify(characteristics):
+            if uuid not in characteristics:
+                return Promise.reject(KeyError(f"UUID {uuid} not found"))
+
+            characteristic_interface = characteristics[uuid].get_interface(CHARACTERISTIC_IFACE)
+            return dbus_callback_promise(characteristic_interface.call_start_notify)
+
+        return self.characteristics_promise.then(_start_notify).catch(self.traceback_printer)
+
     def remove_notify(self, uuid):
         uuid = uuid.casefold()
 
@@ -350,66 +782,162 @@ class BtleDevice:
 
         return self.characteristics_promise.then(_remove_notify).catch(self.traceback_printer)
 
+    def _characteristics_found(self, paths, characteristics):
+        if self.characteristics is not None:
+            # the handlers listen on the old characteristics, they have to be added again
+            for uuid, handlers in self.handlers.items():
+                if uuid in self.characteristics:
+                    for handler in handlers:
+                        self.characteristics[uuid].get_interface(PROPERTIES_IFACE).off_properties_changed(handler)
+
+            self.handlers.clear()
+
+        self.characteristic_paths = paths
+        self.characteristics = characteristics
+        return characteristics
+
+    def _remove_services_resolved_listener(self):
+        if self._services_resolved_listener is not None:
+            self.properties_interface.off_properties_changed(self._services_resolved_listener)
+            self._services_resolved_listener = None
+
     def _get_dbus_proxy_object(self, bus_name, path):
-        return dbus_callback_promise(self.system_bus.introspect, bus_name, path) \
-            .then(lambda introspection: self.system_bus.get_proxy_object(bus_name, path, introspection))
+        return self.proxy_factory.get_proxy_object(bus_name, path)
+
+
+class BacklogSync(NamedTuple):
+    name: str
+    sips: int
+    duration: float
+
+    @property
+    def sips_per_second(self):
+        return self.sips / self.duration if self.duration else 0
 
 
 class WaterBottle:
     """
-    right now contains logic for Hidrate Spark 3
-    probably need to do lots of abstraction/generalizing
-    to work with other water bottles, which I don't have or know about existing.
+    right now contains logic for Hidrate Spark 3, other models can only differ in
+    how their sips are encoded, see bottle_codecs.
     """
-    BOTTLE_SIZE = 592
     SIPS_CHARACTERISTIC_UUID = '016e11b1-6c8a-4074-9e5a-076053f93784'
+    ACK_SIP = bytes.fromhex("57")
 
-    def __init__(self, name: str, device: BtleDevice, sip_stream: deque) -> None:
+    def __init__(self, name: str, device: BtleDevice, sip_stream: deque, codec=None) -> None:
         """
-        connect to device, find correct characteristic, read value, parse it,
+        call connect to connect to the device, find correct characteristic, read value, parse it,
         setup notifications then read sips
         """
         self.sip_stream = sip_stream
+        self.codec = codec or codec_for()
 
         self.traceback_printer = traceback_printer(self.__class__.__name__)
         self.device = device
         self.name = name
-        self.device.connect().then(lambda _: self.device.on_value_change(self.SIPS_CHARACTERISTIC_UUID, self.sips_notification_handler))
-        
+
+        # asking for the next stored sip with a write command skips waiting for a write response
+        self.ack_without_response = False
+        self.sips_characteristic_flags = None
+        # while a backlog of stored sips is drained: [start time, sips so far]
+        self.backlog_drain = None
+        self._backlog_stall_timeout_id = None
+        self.last_backlog_sync: BacklogSync | None = None
+
+    def connect(self):
+        """
+        connects to the bottle, reads any sip waiting on it and subscribes to new ones.
+        Connecting again after a disconnect only resumes notifications on the subscription from before.
+        Returns a Promise for the connection itself.
+        """
+        connected = self.device.connect()
+        connected.then(lambda _: self.device.characteristics_promise).then(lambda _: self.subscribe_to_sips())
+        if self.sips_characteristic_flags is None:
+            self.device.char_flags(self.SIPS_CHARACTERISTIC_UUID).then(self.set_sips_characteristic_flags, self.traceback_printer)
 
         self.device.char_read(self.SIPS_CHARACTERISTIC_UUID) \
             .then(lambda value: value[0]) \
             .then(self.sips_notification_handler, self.traceback_printer)
 
-    def sips_notification_handler(self, value):
-        SipSize, total, secondsAgo, count_of_sips_on_device = self.parseSip(value)
-        if SipSize > 0:
-            self.sip_stream.appendleft((SipSize, datetime.now() - timedelta(milliseconds=secondsAgo), self.name))
+        return connected
 
-        if count_of_sips_on_device > 0:
-            self.device.char_write(self.SIPS_CHARACTERISTIC_UUID, bytes.fromhex("57"))
+    def subscribe_to_sips(self):
+        if self.device.is_subscribed(self.SIPS_CHARACTERISTIC_UUID):
+            return self.device.resume_notify(self.SIPS_CHARACTERISTIC_UUID)
 
-    def parseSip(self, data):
-        """
-        parses sips from data sent by water bottle.
-        # diff-de5804e048e763f99ae84940f91d80e11b58f1b69da346d32a17abd6940e7db4R85
-        code taken from https://github.com/choonkiatlee/wban-python/commit/3c644a32702f2a37e7a9c10f49bc5ebfcbf0a688
-        """
-        # Parsed from dataPointCharacteristicDidUpdate in RxBLEConnectCoordinator.java
-        no_sips_left_on_device = data[0]
-        b2 = data[1] & 255          # Likely some version of sip size as percentage of bottle fullness
+        return self.device.on_value_change(self.SIPS_CHARACTERISTIC_UUID, self.sips_notification_handler)
 
-        SipSize = (self.BOTTLE_SIZE * b2) / 100
+    def set_sips_characteristic_flags(self, flags):
+        self.sips_characteristic_flags = flags
+        self.ack_without_response = 'write-without-response' in flags
 
-        # This bit of list comprehension magic gets us [data[3], data[2]]
-        total = int.from_bytes(data[3:1:-1], "little") & 65535
+    def sips_notification_handler(self, value):
+        started = time.perf_counter() if metrics.ENABLED else None
+        SipSize, total, secondsAgo, count_of_sips_on_device = self.codec.decode(value)
 
-        secondsAgo = int.from_bytes(data[8:4:-1], "little") & -1
+        if count_of_sips_on_device > 0 and self.backlog_drain is None:
+            # the bottle has stored sips, queue them all up and save them in one go
+            self.backlog_drain = [time.monotonic(), 0]
+            self.sip_stream.hold(self.name)
 
-        # print("Sip Size: {0}, Total: {1}, Seconds Ago: {2}, Sips Left: {3}".format(
-        #     SipSize, total, secondsAgo, no_sips_left_on_device))
+        if SipSize > 0:
+            # the sip is journaled here, before the bottle is asked for the next one
+            self.sip_stream.appendleft((SipSize, datetime.now() - timedelta(milliseconds=secondsAgo), self.name))
+            if self.backlog_drain is not None:
+                self.backlog_drain[1] += 1
 
-        return SipSize, total, secondsAgo, no_sips_left_on_device
+        if count_of_sips_on_device > 0:
+            # ask for the next one right away, the bottle sends one stored sip per request
+            self._restart_backlog_stall_timeout()
+            self.device.char_write(self.SIPS_CHARACTERISTIC_UUID, self.ACK_SIP, self.ack_without_response,
+                                   lambda _: self.finish_backlog_drain())
+        else:
+            self.finish_backlog_drain()
+
+        if started is not None:
+            metrics.SIP_NOTIFICATION_SECONDS.observe_since(started)
+            if SipSize > 0:
+                metrics.SIPS_RECEIVED.inc()
+
+    def finish_backlog_drain(self):
+        if self._backlog_stall_timeout_id is not None:
+            GLib.source_remove(self._backlog_stall_timeout_id)
+            self._backlog_stall_timeout_id = None
+
+        if self.backlog_drain is None:
+            return
+
+        started, sips = self.backlog_drain
+        self.backlog_drain = None
+        self.sip_stream.release(self.name)
+
+        self.last_backlog_sync = BacklogSync(self.name, sips, time.monotonic() - started)
+        print(f"{self.name}: synced {sips} stored sips in {self.last_backlog_sync.duration:.2f}s "
+              f"({self.last_backlog_sync.sips_per_second:.1f} sips/s)")
+
+    def _restart_backlog_stall_timeout(self):
+        if self._backlog_stall_timeout_id is not None:
+            GLib.source_remove(self._backlog_stall_timeout_id)
+
+        self._backlog_stall_timeout_id = GLib.timeout_add_seconds(BACKLOG_STALL_TIMEOUT_S, self._backlog_stalled)
+
+    def _backlog_stalled(self):
+        self._backlog_stall_timeout_id = None
+        print(f"{self.name}: no stored sip for {BACKLOG_STALL_TIMEOUT_S}s, saving the backlog drained so far")
+        self.finish_backlog_drain()
+        return False
+
+    def disconnected(self):
+        """
+        the bottle went away, whatever was drained of its backlog still needs saving
+        """
+        self.finish_backlog_drain()
 
     def cleanup(self):
-        self.device.remove_notify(self.SIPS_CHARACTERISTIC_UUID).then(lambda _: self.device.disconnect())
+        """
+        stops notifications and disconnects, returns a Promise for when the bottle is disconnected
+        """
+        # whatever was drained before the bottle went away still needs saving
+        self.finish_backlog_drain()
+        return self.device.remove_notify(self.SIPS_CHARACTERISTIC_UUID) \
+            .then(lambda _: self.device.disconnect()) \
+            .catch(self.traceback_printer)
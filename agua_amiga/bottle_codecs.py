@@ -0,0 +1,68 @@
+"""
+decoders for the sip notifications of each bottle model.
+
+Decoders parse straight out of the notification buffer with precompiled structs, unpack_from
+doesn't copy the payload the way slicing does. Every codec lists golden payloads with what they
+decode to, benchmarks/codecs.py checks them and times each codec, so a new model comes with
+both a correctness check and a speed check.
+"""
+import struct
+from typing import NamedTuple
+
+
+class SipRecord(NamedTuple):
+    """
+    what a decoded sip holds. decode returns plain tuples in this order,
+    building the NamedTuple costs more than decoding the payload.
+    """
+    volume: float       # mL
+    total: int          # running total the bottle keeps, not used yet
+    ms_ago: int         # how long ago the sip was taken
+    sips_left: int      # stored sips still on the bottle after this one
+
+
+class HidrateSpark3Codec:
+    """
+    Hidrate Spark 3 sip notifications, the protocol is documented at
+    https://github.com/choonkiatlee/wban-python/blob/master/Hidrate.py
+    (parsed from dataPointCharacteristicDidUpdate in RxBLEConnectCoordinator.java)
+    """
+    model = 'hidrate_spark_3'
+    bottle_size = 592
+
+    # sips left, sip size as a percentage of the bottle, big endian total, a byte we skip, big endian time ago
+    layout = struct.Struct('>BBHxI')
+
+    golden_payloads = [
+        (bytes.fromhex('03 32 012c 00 00000bb8'), SipRecord(296.0, 300, 3000, 3)),
+        (bytes.fromhex('00 0a 0000 00 00000000'), SipRecord(59.2, 0, 0, 0)),
+        # notifications can be longer than the fields we read
+        (bytes.fromhex('ff 64 ffff 7f ffffffff 0102'), SipRecord(592.0, 65535, 4294967295, 255)),
+    ]
+
+    def decode(self, payload):
+        sips_left, percent, total, ms_ago = self.layout.unpack_from(payload)
+        return self.bottle_size * percent / 100, total, ms_ago, sips_left
+
+    def decode_batch(self, payloads):
+        """
+        decodes a list of notification payloads in one call
+        """
+        unpack_from = self.layout.unpack_from
+        bottle_size = self.bottle_size
+
+        return [(bottle_size * percent / 100, total, ms_ago, sips_left)
+                for sips_left, percent, total, ms_ago in map(unpack_from, payloads)]
+
+
+CODECS = {codec.model: codec for codec in [HidrateSpark3Codec()]}
+
+DEFAULT_MODEL = HidrateSpark3Codec.model
+
+
+def codec_for(model=None):
+    model = model or DEFAULT_MODEL
+    if model not in CODECS:
+        raise KeyError(f"No sip codec for bottle model {model}")
+
+    return CODECS[model]
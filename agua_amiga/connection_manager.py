@@ -0,0 +1,173 @@
+"""
+keeps each bottle's connection up.
+
+A bottle's WaterBottle and BtleDevice live as long as the scanner does. They outlive disconnects and even BlueZ
+removing the device object, because BlueZ gives a device the same object path when it comes back. So the
+proxies, the characteristics found on the first connect, the notify subscription and the last backlog sync are
+all still there when the bottle reconnects. Dropped or failed connections are retried with exponential backoff
+and jitter, so bottles that drop together don't all retry at the same moment. How long each bottle took to
+reconnect is kept.
+"""
+import random
+import time
+
+from gi.repository import GLib
+
+from agua_amiga import metrics
+from agua_amiga.device_registry import DEFAULT_MAX_CONCURRENT_CONNECTS, ConnectionScheduler
+
+RECONNECT_BASE_DELAY_S = 1
+RECONNECT_MAX_DELAY_S = 300
+
+
+def reconnect_delay_s(attempt):
+    """
+    how long to wait before reconnect attempt number attempt (counting from 0). The delay doubles each
+    attempt up to RECONNECT_MAX_DELAY_S, and a random half of it is taken off.
+    """
+    delay = min(RECONNECT_BASE_DELAY_S * 2 ** attempt, RECONNECT_MAX_DELAY_S)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class BottleConnection:
+    """
+    what is known about one bottle's connection, kept across disconnects
+    """
+
+    def __init__(self, path, bottle) -> None:
+        self.path = path
+        self.bottle = bottle
+        self.present = True
+        self.connected = False
+        self.attempts = 0
+        self.disconnected_at = None
+        # seconds from each disconnect until connected again
+        self.reconnect_times = []
+        self.retry_timeout_id = None
+
+    @property
+    def last_sync(self):
+        return self.bottle.last_backlog_sync
+
+
+class ConnectionManager:
+    """
+    connected_callback(path, connected) is called whenever a bottle connects or disconnects.
+    Connects go through a ConnectionScheduler, so only a few are attempted at once.
+    """
+
+    def __init__(self, connected_callback, max_concurrent=DEFAULT_MAX_CONCURRENT_CONNECTS) -> None:
+        self.connected_callback = connected_callback
+        self.scheduler = ConnectionScheduler(max_concurrent, self._connect_finished)
+        self.connections = {}
+        self.running = False
+
+    def add(self, path, bottle):
+        """
+        starts keeping bottle connected and returns it. For a path the manager already knows about,
+        the bottle from before is returned instead, with everything it remembers.
+        """
+        connection = self.connections.get(path)
+        if connection is None:
+            connection = self.connections[path] = BottleConnection(path, bottle)
+            bottle.device.on_connection_change(lambda connected: self._connection_changed(connection, connected))
+
+        connection.present = True
+        if not connection.connected:
+            self._cancel_retry(connection)
+            self._connect(connection)
+
+        return connection.bottle
+
+    def device_removed(self, path):
+        """
+        BlueZ removed the device object, it's connected to again once it's rediscovered
+        """
+        connection = self.connections.get(path)
+        if connection:
+            connection.present = False
+            self._cancel_retry(connection)
+            self.scheduler.cancel(path)
+            self._connection_changed(connection, False)
+
+    def start(self):
+        """
+        the adapter is powered and the scanner started, every disconnected bottle is tried again right away
+        """
+        self.running = True
+        for connection in self.connections.values():
+            if connection.present and not connection.connected:
+                connection.attempts = 0
+                self._cancel_retry(connection)
+                self._connect(connection)
+
+    def stop(self):
+        """
+        stops reconnecting, when the adapter turns off or before bottles are disconnected on purpose
+        """
+        self.running = False
+        for connection in self.connections.values():
+            self._cancel_retry(connection)
+            self.scheduler.cancel(connection.path)
+
+    def reconnect_latencies(self):
+        """
+        seconds the latest reconnect took, by path
+        """
+        return {path: connection.reconnect_times[-1] for path, connection in self.connections.items()
+                if connection.reconnect_times}
+
+    def _connect(self, connection):
+        if self.running:
+            self.scheduler.request(connection.path, connection.bottle.connect)
+
+    def _connect_finished(self, path, connected):
+        connection = self.connections.get(path)
+        if connection is None:
+            return
+
+        if connected:
+            print(f"{connection.bottle.name}: connected in {self.scheduler.connect_latencies[path]:.2f}s")
+            self._connection_changed(connection, True)
+        else:
+            self._schedule_retry(connection)
+
+    def _connection_changed(self, connection, connected):
+        if connected == connection.connected:
+            return
+
+        connection.connected = connected
+        if connected:
+            if connection.disconnected_at is not None:
+                connection.reconnect_times.append(time.monotonic() - connection.disconnected_at)
+                print(f"{connection.bottle.name}: reconnected after {connection.reconnect_times[-1]:.1f}s")
+
+            connection.disconnected_at = None
+            connection.attempts = 0
+        else:
+            connection.disconnected_at = time.monotonic()
+            connection.bottle.disconnected()
+            self._schedule_retry(connection)
+
+        self.connected_callback(connection.path, connected)
+
+    def _schedule_retry(self, connection):
+        if not self.running or not connection.present or connection.retry_timeout_id is not None:
+            return
+
+        delay_s = reconnect_delay_s(connection.attempts)
+        connection.attempts += 1
+
+        def _retry():
+            connection.retry_timeout_id = None
+            if self.running and connection.present and not connection.connected:
+                metrics.BOTTLE_CONNECT_RETRIES.inc()
+                self._connect(connection)
+            return False
+
+        connection.retry_timeout_id = GLib.timeout_add(int(delay_s * 1000), _retry)
+
+    def _cancel_retry(self, connection):
+        if connection.retry_timeout_id is not None:
+            GLib.source_remove(connection.retry_timeout_id)
+            connection.retry_timeout_id = None
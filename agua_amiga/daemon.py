@@ -0,0 +1,117 @@
+"""
+headless sip collector, for a machine that only needs to get sips from bottles into the database.
+
+Runs the scanner and the datastore on a plain GLib main loop, Gtk, the glade templates and libnotify
+are never loaded. The desktop app shows what the daemon saves, it reads the same database.
+
+run with agua_amiga_daemon, or as a systemd user service (systemd/agua_amiga.service)
+"""
+import os
+import signal
+import sys
+
+from gi.repository import GLib
+
+from agua_amiga import metrics
+from agua_amiga.bluetooth_scanner import BluetoothNotSupported, BluetoothScanner, BluetoothStatus
+from agua_amiga.datastore import Datastore
+from agua_amiga.device_registry import DeviceRegistry
+from agua_amiga.ingest import IngestLock, SipIngest
+from agua_amiga.paths import database_path, devices_config_path, ingest_lock_path, journal_path
+from agua_amiga.sip_journal import SipJournal
+
+# how long stopping notifications and disconnecting the bottles may take before the daemon exits anyway
+CLOSE_TIMEOUT_S = 5
+
+
+class Daemon:
+
+    def __init__(self) -> None:
+        self.loop = GLib.MainLoop()
+        self.exit_status = 0
+        self.closing = False
+
+        self.datastore = Datastore(database_path())
+        self.journal = SipJournal(journal_path())
+        self.ingest = SipIngest(self.datastore, self.journal)
+        self.ingest.replay_sip_journal()
+
+        if os.environ.get('AGUA_AMIGA_BLUETOOTH') == 'asyncio':
+            from agua_amiga.aio_bluetooth import AioBluetoothScanner, install_glib_event_loop_policy
+            install_glib_event_loop_policy()
+            scanner_class = AioBluetoothScanner
+        else:
+            scanner_class = BluetoothScanner
+
+        self.scanner = scanner_class(self.bluetooth_status_update, self.devices_update, self.save_queued_sips, self.journal,
+                                     DeviceRegistry.load(devices_config_path()))
+
+    def run(self) -> int:
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal_number, self.quit)
+
+        metrics_exporter = metrics.start_exporter()
+        self.scanner.start_scanner()
+        self.loop.run()
+
+        # write out anything still queued before the process goes away
+        self.save_queued_sips()
+        self.datastore.close()
+        self.journal.close()
+
+        if metrics_exporter:
+            metrics_exporter.stop()
+            print(metrics.summary())
+
+        return self.exit_status
+
+    def quit(self, exit_status=0):
+        """
+        closes the scanner, which needs the main loop running, and stops the loop once that's done
+        """
+        if self.closing:
+            return False
+
+        self.closing = True
+        self.exit_status = exit_status
+        self.scanner.close(self.loop.quit)
+        GLib.timeout_add_seconds(CLOSE_TIMEOUT_S, self.loop.quit)
+        return False
+
+    def save_queued_sips(self):
+        saved = self.ingest.save_queued_sips(self.scanner.sip_stream)
+        if saved:
+            print(f"saved {saved} sips")
+
+    def bluetooth_status_update(self, status: BluetoothStatus, data):
+        print(f"bluetooth {status.name.lower()}")
+
+        if status == BluetoothStatus.ERROR:
+            print(data, file=sys.stderr)
+            # systemd restarts the service, which starts over with a fresh bus connection
+            self.quit(1)
+
+    def devices_update(self, devices):
+        print(f"bottles: {', '.join(device.name for device in devices.values()) or 'none'}")
+
+
+def main():
+    lock = IngestLock(ingest_lock_path())
+    if not lock.acquire():
+        print("another agua_amiga is already collecting sips", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        daemon = Daemon()
+    except BluetoothNotSupported as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        sys.exit(daemon.run())
+    finally:
+        lock.release()
+
+
+if __name__ == '__main__':
+    main()
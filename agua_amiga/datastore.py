@@ -1,6 +1,19 @@
+import queue
 import sqlite3
+import threading
+import traceback
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
 from enum import Enum
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+# save_sips has a time variable of its own
+from time import perf_counter
+from typing import NamedTuple
+
+from agua_amiga import metrics
+
+# the hours reminders used before they were configurable
+DEFAULT_WAKING_HOURS = (6, 18)
 
 
 class Unit(Enum):
@@ -8,6 +21,11 @@ class Unit(Enum):
     ML = 'mL'
 
 
+class Streaks(NamedTuple):
+    current: int
+    longest: int
+
+
 class Datastore:
     """
     Stores water data in a sqlite db
@@ -16,46 +34,189 @@ class Datastore:
     def __init__(self, db_path) -> None:
         self.connection = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
         self.cursor = self.connection.cursor()
+        # settings and the current goal only change through this class, so they are kept
+        # in memory after the first read. See invalidate_cache for other writers.
+        self._cache = {}
+        # goal streaks ending before today, as (first day, last day, length) runs
+        # these only change if old sips show up, see invalidate_days
+        self._closed_streak_runs = []
+        self._streaks_closed_through = None
+        self._days_listeners = []
+
+        # WAL lets a commit be a single sequential write and keeps readers from blocking the writer.
+        # With WAL, synchronous=NORMAL only fsyncs at checkpoints, a crash can't corrupt the db.
+        self.cursor.execute('''PRAGMA journal_mode = WAL''')
+        self.cursor.execute('''PRAGMA synchronous = NORMAL''')
 
         self.ensure_database_tables_exist()
 
+        # to notice what other connections, like the daemon's, have written. See refresh_external_changes
+        self._data_version = self._get_data_version()
+        self._last_drink_rowid = self._get_last_drink_rowid()
+
     def get_display_units(self) -> Unit:
-        self.cursor.execute("Select value from settings where name = 'display_units'")
-        row = self.cursor.fetchone()
+        if 'display_units' not in self._cache:
+            self.cursor.execute("Select value from settings where name = 'display_units'")
+            row = self.cursor.fetchone()
 
-        if row:
-            return Unit(row[0])
+            self._cache['display_units'] = Unit(row[0]) if row else Unit.ML
 
-        return Unit.ML
+        return self._cache['display_units']
 
     def set_display_units(self, units: Unit):
         self.cursor.execute('''INSERT INTO settings (name, value)
                             VALUES('display_units', :units) ON CONFLICT DO UPDATE SET value=excluded.value''', {'units': units.value})
         self.connection.commit()
+        self.cache_setting('display_units', units)
 
-    def save_sip(self, volume, time, source):
-        self.cursor.execute('''INSERT INTO drinks (volume, time, source)
-                            VALUES(:volume, :time, :source)''', {'volume': volume, 'source': source, 'time': time})
+    def get_waking_hours(self):
+        """
+        (start hour, end hour) of the part of the day the goal should be drunk in, reminders only happen then
+        """
+        if 'waking_hours' not in self._cache:
+            self.cursor.execute("Select name, value from settings where name in ('waking_start_hour', 'waking_end_hour')")
+            hours = {name: int(value) for name, value in self.cursor.fetchall()}
+
+            self._cache['waking_hours'] = (hours.get('waking_start_hour', DEFAULT_WAKING_HOURS[0]),
+                                           hours.get('waking_end_hour', DEFAULT_WAKING_HOURS[1]))
+
+        return self._cache['waking_hours']
+
+    def set_waking_hours(self, start_hour, end_hour):
+        self.cursor.executemany('''INSERT INTO settings (name, value)
+                                VALUES(:name, :hour) ON CONFLICT DO UPDATE SET value=excluded.value''',
+                                [{'name': 'waking_start_hour', 'hour': start_hour}, {'name': 'waking_end_hour', 'hour': end_hour}])
         self.connection.commit()
+        self.cache_setting('waking_hours', (start_hour, end_hour))
 
-    def get_daily_goal_volume(self):
-        self.cursor.execute('''SELECT volume FROM goals ORDER BY time DESC''')
+    def cache_setting(self, name, value):
+        """
+        remembers the value of a cached setting (display_units, waking_hours or daily_goal_volume) without reading the db
+        """
+        self._cache[name] = value
+
+    def invalidate_cache(self):
+        """
+        forgets cached settings and goal, call when something else has written to the db
+        """
+        self._cache.clear()
+        self._closed_streak_runs = []
+        self._streaks_closed_through = None
+
+    def refresh_external_changes(self) -> bool:
+        """
+        checks whether another connection has committed since the last check. If it has, the cache
+        is invalidated and days listeners are told which days new sips were saved for.
+        Only SQLite's data_version is read when nothing changed.
+        """
+        data_version = self._get_data_version()
+        if data_version == self._data_version:
+            return False
+
+        self._data_version = data_version
+        self.cursor.execute('''SELECT DISTINCT day FROM drinks WHERE rowid > :rowid''', {'rowid': self._last_drink_rowid})
+        days = {row[0] for row in self.cursor.fetchall()}
+        self._last_drink_rowid = self._get_last_drink_rowid()
+
+        self.invalidate_cache()
+        if days:
+            self.invalidate_days(days)
+
+        return True
+
+    def _get_data_version(self):
+        return self.cursor.execute('''PRAGMA data_version''').fetchone()[0]
+
+    def _get_last_drink_rowid(self):
+        return self.cursor.execute('''SELECT COALESCE(MAX(rowid), 0) FROM drinks''').fetchone()[0]
+
+    def invalidate_days(self, days):
+        """
+        forgets anything cached about the given days, called when sips are saved for them
+        """
+        if self._streaks_closed_through is not None and min(days) <= self._streaks_closed_through:
+            self._closed_streak_runs = []
+            self._streaks_closed_through = None
+
+        for listener in self._days_listeners:
+            listener(days)
+
+    def add_days_listener(self, listener):
+        """
+        listener(days) is called with the YYYY-MM-DD days that sips were saved for
+        """
+        self._days_listeners.append(listener)
+
+    def remove_days_listener(self, listener):
+        self._days_listeners.remove(listener)
+
+    def save_sip(self, volume, time, source):
+        self.save_sips([(volume, time, source)])
+
+    def save_sips(self, sips, journal_seq=None):
+        """
+        saves an iterable of (volume, time, source) sips in a single transaction
+        and returns how many were saved. journal_seq is the sequence number of the newest
+        of these sips in the SipJournal, it is stored in the same transaction.
+        """
+        rows = [{'volume': volume, 'source': source, 'time': time, 'ts': time.timestamp(), 'day': day_key(time)}
+                for volume, time, source in sips]
+
+        totals = defaultdict(lambda: {'volume': 0, 'sips': 0})
+        for row in rows:
+            total = totals[(row['day'], row['source'])]
+            total['volume'] += row['volume']
+            total['sips'] += 1
+
+        started = perf_counter() if metrics.ENABLED else None
+        with self.connection:
+            self.cursor.executemany('''INSERT INTO drinks (volume, time, source, ts, day)
+                                    VALUES(:volume, :time, :source, :ts, :day)''', rows)
+            self.cursor.executemany('''INSERT INTO daily_totals (day, source, volume, sips)
+                                    VALUES(:day, :source, :volume, :sips)
+                                    ON CONFLICT DO UPDATE SET volume = volume + excluded.volume, sips = sips + excluded.sips''',
+                                    [{'day': day, 'source': source, **total} for (day, source), total in totals.items()])
+            self._advance_daily_totals_marker(len(rows))
+            if journal_seq is not None:
+                self.cursor.execute('''INSERT INTO settings (name, value)
+                                    VALUES('journal_committed_seq', :seq) ON CONFLICT DO UPDATE SET value=excluded.value''',
+                                    {'seq': journal_seq})
+
+        if started is not None:
+            metrics.SIP_SAVE_SECONDS.observe(perf_counter() - started)
+
+        if totals:
+            self.invalidate_days({day for day, _ in totals.keys()})
+
+        return len(rows)
+
+    def get_journal_committed_seq(self):
+        """
+        sequence number of the newest SipJournal record that has been saved, 0 if none
+        """
+        self.cursor.execute("Select value from settings where name = 'journal_committed_seq'")
         row = self.cursor.fetchone()
 
-        if row:
-            return row[0]
+        return int(row[0]) if row else 0
 
-        return 0
+    def get_daily_goal_volume(self):
+        if 'daily_goal_volume' not in self._cache:
+            self.cursor.execute('''SELECT volume FROM goals ORDER BY day DESC, ts DESC LIMIT 1''')
+            row = self.cursor.fetchone()
+
+            self._cache['daily_goal_volume'] = row[0] if row else 0
+
+        return self._cache['daily_goal_volume']
 
     def set_daily_goal_volume(self, volume):
-        self.cursor.execute('''INSERT INTO goals (volume, time) VALUES(:volume, :time)''',
-                            {'volume': volume, 'time': datetime.now()})
+        now = datetime.now()
+        self.cursor.execute('''INSERT INTO goals (volume, time, ts, day) VALUES(:volume, :time, :ts, :day)''',
+                            {'volume': volume, 'time': now, 'ts': now.timestamp(), 'day': day_key(now)})
         self.connection.commit()
+        self.cache_setting('daily_goal_volume', volume)
 
     def get_volume_drunk_today(self):
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        self.cursor.execute('''SELECT SUM(volume) FROM drinks WHERE datetime(time) >= datetime(:day_start) AND datetime(time) < datetime(:day_end)''',
-                            {'day_start': today, 'day_end': today + timedelta(days=1)})
+        self.cursor.execute('''SELECT SUM(volume) FROM daily_totals WHERE day = :day''', {'day': day_key(datetime.now())})
 
         row = self.cursor.fetchone()
 
@@ -65,17 +226,437 @@ class Datastore:
         return 0
 
     def get_days_drunk_water(self, date_range_start, date_range_end):
-        self.cursor.execute('''SELECT date(time), SUM(volume) FROM drinks WHERE datetime(time) >= datetime(:day_start) AND datetime(time) < datetime(:day_end) GROUP BY date(time)''',
-                            {'day_start': date_range_start, 'day_end': date_range_end})
+        """
+        returns (day, volume) rows for each day in [date_range_start, date_range_end) with drinks.
+        Totals are kept per day, so datetimes are rounded down to the day they fall on.
+        """
+        self.cursor.execute('''SELECT day, SUM(volume) FROM daily_totals WHERE day >= :range_start AND day < :range_end GROUP BY day''',
+                            {'range_start': day_key(date_range_start), 'range_end': day_key(date_range_end)})
 
         return self.cursor.fetchall()
 
+    def iter_drinks(self, date_range_start=None, date_range_end=None, source=None, chunk_size=1000):
+        """
+        yields (time, volume, source) for drinks in [date_range_start, date_range_end) in time order,
+        optionally only from one source. Rows are fetched chunk_size at a time, so memory use doesn't
+        grow with the history.
+        """
+        return self._iter_rows('''SELECT time, volume, source FROM drinks
+                               WHERE ts >= :range_start AND ts < :range_end AND (:source IS NULL OR source = :source)
+                               ORDER BY ts''',
+                               {'range_start': epoch_seconds(date_range_start) if date_range_start else float('-inf'),
+                                'range_end': epoch_seconds(date_range_end) if date_range_end else float('inf'),
+                                'source': source},
+                               chunk_size)
+
+    def get_drink_columns(self, date_range_start=None, date_range_end=None):
+        """
+        returns (timestamps, local_times, volumes, sources) lists for drinks in [date_range_start, date_range_end),
+        in time order, read in one query. local_times are the local wall clock times as seconds since
+        1970-01-01, so hours and days can be computed with plain arithmetic.
+        """
+        self.cursor.execute('''SELECT ts, (julianday(ts, 'unixepoch', 'localtime') - 2440587.5) * 86400.0, volume, source
+                            FROM drinks WHERE ts >= :range_start AND ts < :range_end ORDER BY ts''',
+                            {'range_start': epoch_seconds(date_range_start) if date_range_start else float('-inf'),
+                             'range_end': epoch_seconds(date_range_end) if date_range_end else float('inf')})
+        rows = self.cursor.fetchall()
+
+        if not rows:
+            return [], [], [], []
+
+        return tuple(list(column) for column in zip(*rows))
+
+    def iter_goals(self, chunk_size=1000):
+        """
+        yields (time, volume) for every goal that was set, oldest first
+        """
+        return self._iter_rows('''SELECT time, volume FROM goals ORDER BY day, ts''', {}, chunk_size)
+
+    def _iter_rows(self, sql, parameters, chunk_size):
+        # own cursor so other queries can run while the caller is consuming rows
+        cursor = self.connection.cursor()
+        cursor.execute(sql, parameters)
+
+        try:
+            while rows := cursor.fetchmany(chunk_size):
+                yield from rows
+        finally:
+            cursor.close()
+
+    def get_goal_attainment(self, date_range_start, date_range_end):
+        """
+        returns (day, volume, goal) rows for each day in [date_range_start, date_range_end) with drinks,
+        where goal is the goal that was in force on that day, 0 if none was set yet
+        """
+        self.cursor.execute(ATTAINMENT_QUERY + '''SELECT day, volume, goal FROM attainment ORDER BY day''',
+                            {'range_start': day_key(date_range_start), 'range_end': day_key(date_range_end)})
+
+        return self.cursor.fetchall()
+
+    def get_streaks(self) -> Streaks:
+        """
+        current and longest run of consecutive days that met the goal in force on each day.
+        The current streak still counts while today's goal hasn't been met yet.
+        """
+        today = date.today()
+        yesterday = day_key(today - timedelta(days=1))
+
+        # only the days that closed since the last call have to be looked at
+        if self._streaks_closed_through is None or self._streaks_closed_through < yesterday:
+            after = self._streaks_closed_through or ''
+            self.cursor.execute(ATTAINMENT_QUERY + STREAK_RUNS_QUERY,
+                                {'range_start': day_key(next_day(after)) if after else '', 'range_end': day_key(today)})
+
+            for run in self.cursor.fetchall():
+                runs = self._closed_streak_runs
+                if runs and day_key(next_day(runs[-1][1])) == run[0]:
+                    runs[-1] = (runs[-1][0], run[1], runs[-1][2] + run[2])
+                else:
+                    runs.append(tuple(run))
+
+            self._streaks_closed_through = yesterday
+
+        runs = self._closed_streak_runs
+        current = runs[-1][2] if runs and runs[-1][1] == yesterday else 0
+
+        goal_volume = self.get_daily_goal_volume()
+        if goal_volume > 0 and self.get_volume_drunk_today() >= goal_volume:
+            current += 1
+
+        return Streaks(current, max([current] + [run[2] for run in runs]))
+
+    def close(self):
+        self.connection.close()
+
     def ensure_database_tables_exist(self):
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS settings (name text primary key, value text)''')
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS goals (volume real, time timestamp)''')
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS drinks (volume real, time timestamp, source text)''')
         self.connection.commit()
 
+        migrated = self.migrate_database_schema()
+
+        # save_sips keeps the rollup, and a marker of the drinks it covers, in step with drinks. Comparing the
+        # marker is cheap, the full check scans all of drinks and only runs when something else wrote drinks,
+        # like an older version of the app or the sqlite shell
+        self.cursor.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name''', {'name': 'daily_totals'})
+        if not self.cursor.fetchone():
+            with self.connection:
+                _add_daily_totals_table(self.cursor)
+            self.rebuild_daily_totals()
+        elif migrated or not self.daily_totals_marker_matches():
+            if self.daily_totals_consistent():
+                with self.connection:
+                    self._write_daily_totals_marker()
+            else:
+                self.rebuild_daily_totals()
+
+    def daily_totals_marker_matches(self):
+        """
+        checks the newest rowid and the number of rows in drinks against what the rollup was last kept in step with
+        """
+        self.cursor.execute('''SELECT name, value FROM settings WHERE name IN ('daily_totals_max_rowid', 'daily_totals_drinks')''')
+        marker = {name: int(value) for name, value in self.cursor.fetchall()}
+        self.cursor.execute('''SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM drinks''')
+        max_rowid, count = self.cursor.fetchone()
+
+        return marker.get('daily_totals_max_rowid') == max_rowid and marker.get('daily_totals_drinks') == count
+
+    def _write_daily_totals_marker(self):
+        self.cursor.execute('''INSERT INTO settings (name, value)
+                            SELECT 'daily_totals_max_rowid', COALESCE(MAX(rowid), 0) FROM drinks WHERE true
+                            ON CONFLICT DO UPDATE SET value=excluded.value''')
+        self.cursor.execute('''INSERT INTO settings (name, value)
+                            SELECT 'daily_totals_drinks', COUNT(*) FROM drinks WHERE true
+                            ON CONFLICT DO UPDATE SET value=excluded.value''')
+
+    def _advance_daily_totals_marker(self, added):
+        # counting drinks again would scan them, the count only grows by what was just added
+        self.cursor.execute('''INSERT INTO settings (name, value)
+                            SELECT 'daily_totals_max_rowid', COALESCE(MAX(rowid), 0) FROM drinks WHERE true
+                            ON CONFLICT DO UPDATE SET value=excluded.value''')
+        self.cursor.execute('''INSERT INTO settings (name, value) VALUES('daily_totals_drinks', :added)
+                            ON CONFLICT DO UPDATE SET value = value + excluded.value''', {'added': added})
+
+    def daily_totals_consistent(self):
+        """
+        checks that the daily_totals rollup accounts for every row in drinks
+        """
+        self.cursor.execute('''SELECT COUNT(*), TOTAL(volume) FROM drinks''')
+        drinks_count, drinks_volume = self.cursor.fetchone()
+        self.cursor.execute('''SELECT TOTAL(sips), TOTAL(volume) FROM daily_totals''')
+        totals_count, totals_volume = self.cursor.fetchone()
+
+        return drinks_count == totals_count and abs(drinks_volume - totals_volume) < 0.001
+
+    def rebuild_daily_totals(self):
+        with self.connection:
+            self.cursor.execute('''DELETE FROM daily_totals''')
+            self.cursor.execute('''INSERT INTO daily_totals (day, source, volume, sips)
+                                SELECT day, source, SUM(volume), COUNT(*) FROM drinks GROUP BY day, source''')
+            self._write_daily_totals_marker()
+
+    def migrate_database_schema(self):
+        """
+        brings the tables created by ensure_database_tables_exist up to SCHEMA_VERSION and returns
+        whether any migration ran. The version of a db file is kept in sqlite's user_version pragma.
+        """
+        self.cursor.execute('''PRAGMA user_version''')
+        version = self.cursor.fetchone()[0]
+
+        for next_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            # sqlite3 doesn't open a transaction for DDL on its own, without BEGIN an interrupted
+            # migration would leave its ALTERs behind with the old user_version
+            self.cursor.execute('''BEGIN''')
+            try:
+                migration(self.cursor)
+                # pragmas can't take parameters, next_version is always an int we produced
+                self.cursor.execute(f'''PRAGMA user_version = {next_version:d}''')
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+        return version < len(MIGRATIONS)
+
+
+class AsyncDatastore:
+    """
+    Datastore that does its work on a background writer thread, so the main loop never waits on disk.
+
+    The writer thread owns its own connection and works through a queue of operations. Write methods
+    return a Future right away. Read methods are answered from a second connection on the calling thread,
+    which WAL mode lets read while the writer commits. query runs a read on the writer thread instead,
+    after anything queued before it, and hands the result to a callback.
+
+    dispatch(func, *args) runs callbacks on the thread that owns the UI, GLib.idle_add for the app.
+    changed_callback is dispatched after each write is committed.
+    """
+
+    def __init__(self, db_path, dispatch=None, changed_callback=None) -> None:
+        # opening the reader first creates and migrates the tables before the writer starts
+        self.reader = Datastore(db_path)
+        self.dispatch = dispatch or (lambda func, *args: func(*args))
+        self.changed_callback = changed_callback
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._run_writer, args=(db_path,),
+                                        name="agua_amiga datastore writer", daemon=True)
+        self._writer.start()
+
+    def __getattr__(self, name):
+        # anything that isn't a write is a read served by the reader connection
+        return getattr(self.reader, name)
+
+    def save_sip(self, volume, time, source) -> Future:
+        return self.save_sips([(volume, time, source)])
+
+    def save_sips(self, sips, journal_seq=None) -> Future:
+        # materialize now, the iterable may not be safe to consume from the writer thread
+        sips = list(sips)
+        days = {day_key(time) for _, time, _ in sips}
+
+        def _invalidate_reader_days(_saved):
+            if days:
+                self.reader.invalidate_days(days)
+
+        return self._submit('save_sips', (sips, journal_seq), _invalidate_reader_days)
+
+    def set_display_units(self, units: Unit) -> Future:
+        self.reader.cache_setting('display_units', units)
+        return self._submit('set_display_units', (units,))
+
+    def set_daily_goal_volume(self, volume) -> Future:
+        self.reader.cache_setting('daily_goal_volume', volume)
+        return self._submit('set_daily_goal_volume', (volume,))
+
+    def set_waking_hours(self, start_hour, end_hour) -> Future:
+        self.reader.cache_setting('waking_hours', (start_hour, end_hour))
+        return self._submit('set_waking_hours', (start_hour, end_hour))
+
+    def query(self, method_name, *args, callback=None) -> Future:
+        """
+        runs Datastore.<method_name>(*args) on the writer thread and dispatches callback(result)
+        """
+        return self._submit(method_name, args, callback, changes_data=False)
+
+    def flush(self):
+        """
+        blocks until every queued operation has been run
+        """
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+            self.reader.close()
+
+    def _submit(self, method_name, args, callback=None, changes_data=True) -> Future:
+        future = Future()
+        self._queue.put((future, method_name, args, callback, changes_data))
+        return future
+
+    def _run_writer(self, db_path):
+        writer = Datastore(db_path)
+
+        while True:
+            operation = self._queue.get()
+            if operation is None:
+                self._queue.task_done()
+                break
+
+            future, method_name, args, callback, changes_data = operation
+            try:
+                if future.set_running_or_notify_cancel():
+                    self._run_operation(writer, future, method_name, args, callback, changes_data)
+            finally:
+                self._queue.task_done()
+
+        writer.close()
+
+    def _run_operation(self, writer, future, method_name, args, callback, changes_data):
+        try:
+            result = getattr(writer, method_name)(*args)
+        except Exception as e:
+            traceback.print_exception(e)
+            future.set_exception(e)
+            return
+
+        future.set_result(result)
+
+        if callback:
+            self.dispatch(callback, result)
+        if changes_data and self.changed_callback:
+            self.dispatch(self.changed_callback)
+
+
+class DayTotalsCache:
+    """
+    per day water totals for browsing history. A whole year is read with one query the first time
+    any of its days is asked for, and the least recently used years are dropped past max_years.
+    Years are reloaded when sips are saved for one of their days.
+    """
+
+    def __init__(self, datastore: Datastore, max_years=3) -> None:
+        self.datastore = datastore
+        self.max_years = max_years
+        self._years = OrderedDict()
+
+        datastore.add_days_listener(self.invalidate_days)
+
+    def get_month(self, year, month):
+        """
+        returns {day: volume} for the days of the month that had drinks
+        """
+        return {day: volume for day, volume in self._get_year(year).items() if day.month == month}
+
+    def get_day(self, day: date):
+        return self._get_year(day.year).get(day, 0)
+
+    def invalidate_days(self, days):
+        for day in days:
+            self._years.pop(date.fromisoformat(day).year, None)
+
+    def close(self):
+        self.datastore.remove_days_listener(self.invalidate_days)
+
+    def _get_year(self, year):
+        if year in self._years:
+            self._years.move_to_end(year)
+        else:
+            rows = self.datastore.get_days_drunk_water(date(year, 1, 1), date(year + 1, 1, 1))
+            self._years[year] = {date.fromisoformat(day): volume for day, volume in rows}
+
+            while len(self._years) > self.max_years:
+                self._years.popitem(last=False)
+
+        return self._years[year]
+
+
+def day_key(value) -> str:
+    """
+    the local calendar day a drink (or a date range bound) falls on, stored as YYYY-MM-DD
+    """
+    if isinstance(value, datetime):
+        value = value.date()
+
+    return value.isoformat()
+
+
+def next_day(day: str) -> date:
+    return date.fromisoformat(day) + timedelta(days=1)
+
+
+def epoch_seconds(value) -> float:
+    """
+    converts a date (taken as local midnight) or naive local datetime to a unix timestamp
+    """
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.min.time())
+
+    return value.timestamp()
+
+
+def _add_drink_timestamp_columns(cursor: sqlite3.Cursor):
+    # datetime(time) in a WHERE clause can't use an index, so keep a numeric
+    # timestamp and the local day next to the original time column
+    cursor.execute('''ALTER TABLE drinks ADD COLUMN ts real''')
+    cursor.execute('''ALTER TABLE drinks ADD COLUMN day text''')
+
+    cursor.execute('''SELECT rowid, time FROM drinks''')
+    rows = [{'rowid': rowid, 'ts': time.timestamp(), 'day': day_key(time)} for rowid, time in cursor.fetchall()]
+    cursor.executemany('''UPDATE drinks SET ts = :ts, day = :day WHERE rowid = :rowid''', rows)
+
+    cursor.execute('''CREATE INDEX IF NOT EXISTS drinks_ts ON drinks (ts)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS drinks_day ON drinks (day)''')
+
+
+def _add_daily_totals_table(cursor: sqlite3.Cursor):
+    # rollup of drinks maintained by save_sip, Datastore rebuilds it when it's out of sync
+    cursor.execute('''CREATE TABLE IF NOT EXISTS daily_totals
+                   (day text, source text, volume real, sips integer, PRIMARY KEY (day, source))''')
+
+
+def _add_goal_timestamp_columns(cursor: sqlite3.Cursor):
+    # lets the goal in force on a day be found with an index lookup, see ATTAINMENT_QUERY
+    cursor.execute('''ALTER TABLE goals ADD COLUMN ts real''')
+    cursor.execute('''ALTER TABLE goals ADD COLUMN day text''')
+
+    cursor.execute('''SELECT rowid, time FROM goals''')
+    rows = [{'rowid': rowid, 'ts': time.timestamp(), 'day': day_key(time)} for rowid, time in cursor.fetchall()]
+    cursor.executemany('''UPDATE goals SET ts = :ts, day = :day WHERE rowid = :rowid''', rows)
+
+    cursor.execute('''CREATE INDEX IF NOT EXISTS goals_day_ts ON goals (day, ts)''')
+
+
+# each entry upgrades the schema by one version, SCHEMA_VERSION is the version of a fully migrated db
+MIGRATIONS = [
+    _add_drink_timestamp_columns,
+    _add_daily_totals_table,
+    _add_goal_timestamp_columns,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Each day's total joined "as of" that day against goals: a goal is in force from the day it was set
+# until the day the next one was set, and the last goal set on a day is the one that counts for it.
+# The correlated subquery is a single backwards step on goals_day_ts per day.
+ATTAINMENT_QUERY = '''WITH totals AS (
+    SELECT day, SUM(volume) AS volume FROM daily_totals WHERE day >= :range_start AND day < :range_end GROUP BY day
+), attainment AS (
+    SELECT day, volume, COALESCE((SELECT goals.volume FROM goals WHERE goals.day <= totals.day
+                                  ORDER BY goals.day DESC, goals.ts DESC LIMIT 1), 0) AS goal
+    FROM totals
+)
+'''
+
+# gaps and islands: consecutive days minus their row number is the same for every day of a run
+STREAK_RUNS_QUERY = ''', islands AS (
+    SELECT day, julianday(day) - ROW_NUMBER() OVER (ORDER BY day) AS island
+    FROM attainment WHERE goal > 0 AND volume >= goal
+)
+SELECT MIN(day), MAX(day), COUNT(*) FROM islands GROUP BY island ORDER BY MIN(day)'''
+
 
 # we use mL internally and convert to fluid ounces if they are chosen.
 # see the Readme.md file
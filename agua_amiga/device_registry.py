@@ -0,0 +1,198 @@
+"""
+which Bluetooth devices are water bottles we should connect to, and when to connect to them.
+
+The registry is configured with a JSON file (devices.json in the user config dir), e.g.
+
+    {
+        "bottles": [
+            {"alias": "h2o10C28", "model": "hidrate_spark_3"},
+            {"address": "F0:12:34:56:78:9A"},
+            {"manufacturer_id": 1234, "manufacturer_data_prefix": "0a0b"}
+        ],
+        "max_concurrent_connects": 2,
+        "discovery_uuids": [],
+        "rssi_threshold": -90
+    }
+
+A device matches a bottle entry when it matches every field given in that entry.
+discovery_uuids and rssi_threshold go into the BlueZ discovery filter, so devices that don't
+advertise one of those service UUIDs, or are weaker than the threshold (in dBm), aren't reported at all.
+model picks the sip codec in bottle_codecs, it defaults to the Hidrate Spark 3.
+Without a config file the registry matches the Hidrate Spark 3 alias we know about.
+"""
+import json
+import os.path
+import time
+import traceback
+from collections import deque
+
+from agua_amiga import metrics
+
+DEFAULT_ALIASES = ['h2o10C28']
+
+# BlueZ adapters start failing LE connects when more than a few are pending at once
+DEFAULT_MAX_CONCURRENT_CONNECTS = 2
+
+
+class DeviceFilter:
+
+    def __init__(self, alias=None, address=None, manufacturer_id=None, manufacturer_data_prefix=None, model=None) -> None:
+        self.alias = alias
+        self.address = address.upper() if address else None
+        self.manufacturer_id = manufacturer_id
+        self.manufacturer_data_prefix = bytes.fromhex(manufacturer_data_prefix) if manufacturer_data_prefix else None
+        self.model = model
+
+    def matches(self, device_properties) -> bool:
+        """
+        device_properties are the org.bluez.Device1 properties, as Variants
+        """
+        if self.alias is not None and _value(device_properties, 'Alias') != self.alias:
+            return False
+
+        if self.address is not None and (_value(device_properties, 'Address') or '').upper() != self.address:
+            return False
+
+        if self.manufacturer_id is not None:
+            manufacturer_data = _value(device_properties, 'ManufacturerData') or {}
+            if self.manufacturer_id not in manufacturer_data:
+                return False
+
+            data = bytes(_unwrap(manufacturer_data[self.manufacturer_id]))
+            if self.manufacturer_data_prefix is not None and not data.startswith(self.manufacturer_data_prefix):
+                return False
+
+        return True
+
+
+class DeviceRegistry:
+
+    def __init__(self, filters=None, max_concurrent_connects=DEFAULT_MAX_CONCURRENT_CONNECTS,
+                 discovery_uuids=None, rssi_threshold=None) -> None:
+        self.filters = filters if filters is not None else [DeviceFilter(alias=alias) for alias in DEFAULT_ALIASES]
+        self.max_concurrent_connects = max_concurrent_connects
+        self.discovery_uuids = discovery_uuids or []
+        self.rssi_threshold = rssi_threshold
+
+    @classmethod
+    def load(cls, config_path):
+        """
+        reads the registry from a JSON config file, the defaults are used when it doesn't exist
+        """
+        if not os.path.exists(config_path):
+            return cls()
+
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+
+        return cls([DeviceFilter(**bottle) for bottle in config.get('bottles', [])],
+                   config.get('max_concurrent_connects', DEFAULT_MAX_CONCURRENT_CONNECTS),
+                   config.get('discovery_uuids'), config.get('rssi_threshold'))
+
+    def is_bottle(self, device_properties) -> bool:
+        if _value(device_properties, 'Blocked'):
+            return False
+
+        return any(device_filter.matches(device_properties) for device_filter in self.filters)
+
+    def all_present(self, connected_device_properties) -> bool:
+        """
+        whether the connected devices are every bottle we expect. Bottles configured by address are expected
+        to all be there, otherwise we can't know how many there are and any one connected bottle will do.
+        """
+        address_filters = [device_filter for device_filter in self.filters if device_filter.address is not None]
+        if address_filters:
+            return all(any(device_filter.matches(properties) for properties in connected_device_properties)
+                       for device_filter in address_filters)
+
+        return bool(connected_device_properties)
+
+    def discovery_filter(self):
+        """
+        arguments for BlueZ's SetDiscoveryFilter, as plain values
+        """
+        discovery_filter = {'Transport': 'le', 'DuplicateData': False}
+        if self.discovery_uuids:
+            discovery_filter['UUIDs'] = self.discovery_uuids
+        if self.rssi_threshold is not None:
+            discovery_filter['RSSI'] = self.rssi_threshold
+
+        return discovery_filter
+
+    def model_for(self, device_properties):
+        """
+        bottle model of the first entry the device matches, None for the default model
+        """
+        for device_filter in self.filters:
+            if device_filter.matches(device_properties):
+                return device_filter.model
+
+        return None
+
+
+class ConnectionScheduler:
+    """
+    limits how many devices are connecting at once. Connects over the limit wait
+    in a first come first served queue, and how long each connect took is kept per device.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT_CONNECTS, finished_callback=None) -> None:
+        """
+        finished_callback(path, connected) is called when each connect is done
+        """
+        self.max_concurrent = max_concurrent
+        self.finished_callback = finished_callback
+        self.connect_latencies = {}
+        self._waiting = deque()
+        self._connecting = {}
+
+    def request(self, path, connect):
+        """
+        connect() starts connecting the device at path and returns a Promise for when it's done
+        """
+        if path in self._connecting or any(waiting_path == path for waiting_path, _ in self._waiting):
+            return
+
+        self._waiting.append((path, connect))
+        self._start_next()
+
+    def cancel(self, path):
+        """
+        forgets a device that went away, if it hasn't started connecting yet
+        """
+        self._waiting = deque((waiting_path, connect) for waiting_path, connect in self._waiting if waiting_path != path)
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def _start_next(self):
+        while self._waiting and len(self._connecting) < self.max_concurrent:
+            path, connect = self._waiting.popleft()
+            self._connecting[path] = time.monotonic()
+
+            try:
+                connect().then(lambda _, path=path: self._finished(path, True),
+                               lambda _, path=path: self._finished(path, False))
+            except Exception as e:
+                traceback.print_exception(e)
+                del self._connecting[path]
+
+    def _finished(self, path, connected):
+        started = self._connecting.pop(path, None)
+        if connected and started is not None:
+            self.connect_latencies[path] = time.monotonic() - started
+            metrics.BOTTLE_CONNECT_SECONDS.observe(self.connect_latencies[path])
+
+        if started is not None and self.finished_callback:
+            self.finished_callback(path, connected)
+
+        self._start_next()
+
+
+def _value(properties, name):
+    return _unwrap(properties.get(name))
+
+
+def _unwrap(value):
+    return getattr(value, 'value', value)
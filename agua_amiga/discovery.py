@@ -0,0 +1,163 @@
+"""
+when the adapter should be discovering.
+
+Discovery runs all the time while a bottle we know about isn't connected. Once every bottle is,
+it only runs for a short window every few minutes, to notice new bottles. Every advertiser in range
+causes D-Bus signals while discovering, so this saves radio time, wakeups and signal traffic.
+How much of the time discovery ran (the duty cycle) and how many signals arrived are kept in DiscoveryStats.
+"""
+import time
+from collections import Counter
+
+from dbus_next import Message, MessageType
+from gi.repository import GLib
+
+from agua_amiga import metrics
+
+# while every bottle is connected, discover for IDLE_WINDOW_S every IDLE_INTERVAL_S
+IDLE_INTERVAL_S = 300
+IDLE_WINDOW_S = 10
+
+# RSSI and ManufacturerData updates of every device in range, most of the signals discovery causes.
+# Nothing else subscribes to devices that aren't bottles, so without this match they'd go uncounted,
+# with it every advertiser in range wakes the app. It's only added with metrics on.
+DEVICE_PROPERTIES_MATCH = ("type='signal',sender='org.bluez',interface='org.freedesktop.DBus.Properties',"
+                           "member='PropertiesChanged',arg0='org.bluez.Device1'")
+
+
+class DiscoveryStats:
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.discovering_since = None
+        self.discovering_time = 0
+        self.signals = Counter()
+
+    def discovering(self, discovering):
+        now = time.monotonic()
+        if discovering and self.discovering_since is None:
+            self.discovering_since = now
+        elif not discovering and self.discovering_since is not None:
+            self.discovering_time += now - self.discovering_since
+            self.discovering_since = None
+
+    def count_signal(self, name):
+        self.signals[name] += 1
+
+    def count_device_properties(self, bus):
+        """
+        with metrics on, counts the PropertiesChanged signals of every BlueZ device, bottle or not, arriving on bus.
+        Otherwise only the bottles' are counted, by count_bottle_properties.
+        """
+        if not metrics.ENABLED:
+            return
+
+        def _device_properties_handler(message):
+            if message.message_type == MessageType.SIGNAL and message.member == 'PropertiesChanged' \
+                    and message.body and message.body[0] == 'org.bluez.Device1':
+                self.count_signal('Device PropertiesChanged')
+
+        bus.add_message_handler(_device_properties_handler)
+        bus.send(Message(destination='org.freedesktop.DBus', path='/org/freedesktop/DBus', interface='org.freedesktop.DBus',
+                         member='AddMatch', signature='s', body=[DEVICE_PROPERTIES_MATCH]))
+
+    def count_bottle_properties(self, iface_name, props_changed, props_removed):
+        """
+        PropertiesChanged listener for a bottle's device proxy, which receives these signals anyway
+        """
+        if not metrics.ENABLED and iface_name == 'org.bluez.Device1':
+            self.count_signal('Bottle PropertiesChanged')
+
+    @property
+    def duty_cycle(self):
+        """
+        fraction of the time since the scanner started that the adapter was discovering
+        """
+        now = time.monotonic()
+        discovering_time = self.discovering_time + (now - self.discovering_since if self.discovering_since is not None else 0)
+        return discovering_time / (now - self.started) if now > self.started else 0
+
+    def signal_rates(self):
+        """
+        signals per second since the scanner started, by signal name
+        """
+        elapsed = time.monotonic() - self.started
+        return {name: count / elapsed for name, count in self.signals.items()} if elapsed > 0 else {}
+
+    def summary(self):
+        rates = ', '.join(f"{name} {rate:.2f}/s" for name, rate in sorted(self.signal_rates().items()))
+        return f"discovery duty cycle {self.duty_cycle:.1%}, signals: {rates or 'none'}"
+
+
+class DiscoveryPolicy:
+    """
+    set_discovering(bool) starts or stops discovery on the adapter. Call bottles_present
+    whenever a bottle connects or goes away.
+    """
+
+    def __init__(self, set_discovering, idle_interval_s=IDLE_INTERVAL_S, idle_window_s=IDLE_WINDOW_S) -> None:
+        self.set_discovering = set_discovering
+        self.idle_interval_s = idle_interval_s
+        self.idle_window_s = idle_window_s
+
+        self.stats = DiscoveryStats()
+        self.running = False
+        self.all_present = False
+        self.discovering = False
+        self._timeout_id = None
+
+    def start(self):
+        """
+        the adapter is powered and the scanner started, discovering starts unless every bottle is already connected
+        """
+        self.running = True
+        self._plan()
+
+    def stop(self):
+        """
+        the scanner stopped or the adapter turned off, which ends discovery without us asking
+        """
+        self.running = False
+        self._cancel_timeout()
+        self._discovering(False, ask_adapter=False)
+
+    def bottles_present(self, all_present):
+        if all_present == self.all_present:
+            return
+
+        self.all_present = all_present
+        print(f"{'every bottle is connected' if all_present else 'looking for bottles'}, {self.stats.summary()}")
+
+        if self.running:
+            self._plan()
+
+    def _plan(self):
+        self._cancel_timeout()
+
+        if self.all_present:
+            self._discovering(False)
+            self._timeout_id = GLib.timeout_add_seconds(self.idle_interval_s, self._idle_window)
+        else:
+            self._discovering(True)
+
+    def _idle_window(self):
+        self._discovering(True)
+        self._timeout_id = GLib.timeout_add_seconds(self.idle_window_s, self._idle_window_over)
+        return False
+
+    def _idle_window_over(self):
+        self._timeout_id = None
+        self._plan()
+        return False
+
+    def _discovering(self, discovering, ask_adapter=True):
+        if discovering != self.discovering:
+            self.discovering = discovering
+            self.stats.discovering(discovering)
+            if ask_adapter:
+                self.set_discovering(discovering)
+
+    def _cancel_timeout(self):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
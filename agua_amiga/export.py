@@ -0,0 +1,146 @@
+"""
+exports water data to files that are easy to analyze elsewhere.
+
+Rows are streamed from the Datastore and written as they are read, so exporting
+years of history doesn't need more memory than exporting a day.
+Parquet needs pyarrow, which is only used if it is installed.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os.path
+from datetime import date, datetime
+
+from agua_amiga.datastore import Datastore
+from agua_amiga.paths import database_path
+
+FORMATS = ['csv', 'jsonl', 'parquet']
+TABLES = ['drinks', 'goals']
+
+COLUMNS = {
+    'drinks': ['time', 'volume_ml', 'source'],
+    'goals': ['time', 'volume_ml'],
+}
+
+EXTENSIONS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.parquet': 'parquet',
+}
+
+CHUNK_SIZE = 1000
+
+
+class ExportError(Exception):
+    pass
+
+
+def export(datastore: Datastore, path, table='drinks', file_format=None, date_range_start=None, date_range_end=None, source=None):
+    """
+    writes the drinks or goals table to path and returns the number of rows written.
+    The format is guessed from the file extension when it isn't given.
+    Date range and source filters only apply to drinks.
+    """
+    file_format = file_format or guess_format(path)
+    if file_format not in FORMATS:
+        raise ExportError(f"Unknown export format {file_format}")
+
+    if table == 'drinks':
+        rows = datastore.iter_drinks(date_range_start, date_range_end, source, chunk_size=CHUNK_SIZE)
+    elif table == 'goals':
+        rows = datastore.iter_goals(chunk_size=CHUNK_SIZE)
+    else:
+        raise ExportError(f"Unknown table {table}")
+
+    writer = {'csv': write_csv, 'jsonl': write_jsonl, 'parquet': write_parquet}[file_format]
+    return writer(path, COLUMNS[table], rows)
+
+
+def guess_format(path):
+    extension = os.path.splitext(path)[1].casefold()
+    if extension not in EXTENSIONS:
+        raise ExportError(f"Can't tell the export format from {path}, use one of {', '.join(EXTENSIONS)}")
+
+    return EXTENSIONS[extension]
+
+
+def write_csv(path, columns, rows):
+    count = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(_serialize_row(row))
+            count += 1
+
+    return count
+
+
+def write_jsonl(path, columns, rows):
+    count = 0
+    with open(path, 'w') as file:
+        for row in rows:
+            file.write(json.dumps(dict(zip(columns, _serialize_row(row)))))
+            file.write('\n')
+            count += 1
+
+    return count
+
+
+def write_parquet(path, columns, rows):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ExportError("Exporting to Parquet needs pyarrow to be installed") from e
+
+    types = {'time': pyarrow.timestamp('us'), 'volume_ml': pyarrow.float64(), 'source': pyarrow.string()}
+    schema = pyarrow.schema([(column, types[column]) for column in columns])
+
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        rows = iter(rows)
+        # one record batch per chunk keeps memory flat
+        while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(values, type=types[column]) for column, values in zip(columns, zip(*chunk))],
+                schema=schema))
+            count += len(chunk)
+
+    return count
+
+
+def _serialize_row(row):
+    return [value.isoformat() if isinstance(value, (date, datetime)) else value for value in row]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='agua_amiga_export', description="Export Agua Amiga water data")
+    parser.add_argument('output', help="file to write, the format is guessed from .csv, .jsonl or .parquet")
+    parser.add_argument('--table', choices=TABLES, default='drinks')
+    parser.add_argument('--format', choices=FORMATS, dest='file_format')
+    parser.add_argument('--start', type=date.fromisoformat, help="first day to export (YYYY-MM-DD)")
+    parser.add_argument('--end', type=date.fromisoformat, help="day to stop before (YYYY-MM-DD)")
+    parser.add_argument('--source', help="only export drinks from this source, e.g. manual or a bottle name")
+    parser.add_argument('--database', help="water.db to read, defaults to the app's database")
+    args = parser.parse_args(argv)
+
+    if args.database:
+        db_path = args.database
+    else:
+        db_path = database_path()
+
+    datastore = Datastore(db_path)
+    try:
+        count = export(datastore, args.output, args.table, args.file_format, args.start, args.end, args.source)
+    except ExportError as e:
+        parser.error(str(e))
+    finally:
+        datastore.close()
+
+    print(f"Exported {count} {args.table} to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
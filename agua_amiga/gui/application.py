@@ -1,37 +1,74 @@
-from datetime import datetime, timedelta
 import os
 import os.path
+import time
 import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("Notify", "0.7")
 from gi.repository import GLib, Gio, Gtk, Notify, Gdk
 
 from .main_window import MainWindow
+from .resources import load_css
+from agua_amiga import metrics, startup_trace
 from agua_amiga.bluetooth_scanner import BluetoothNotSupported, BluetoothScanner, BluetoothStatus
-from agua_amiga.datastore import Datastore
+from agua_amiga.datastore import AsyncDatastore, Datastore
+from agua_amiga.device_registry import DeviceRegistry
+from agua_amiga.ingest import IngestLock, SipIngest
+from agua_amiga.paths import database_path, devices_config_path, ingest_lock_path, journal_path
+from agua_amiga.reminders import ReminderScheduler
+from agua_amiga.sip_journal import SipJournal
 
 class Application(Gtk.Application):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, application_id="me.rehack.agua_amiga",
                          flags=Gio.ApplicationFlags.FLAGS_NONE, **kwargs)
         self.window = None
-        self.scanner = BluetoothScanner(self.bluetooth_status_update, self.devices_update)
 
-        data_path = GLib.get_user_data_dir() + '/agua_amiga/'
-
-        if not os.path.exists(data_path):
-            os.mkdir(data_path)
-
-        database_name = "water.db"
-        self.datastore = Datastore(data_path + database_name)
+        # opt in to doing database work off the main loop
+        self.async_datastore = bool(os.environ.get('AGUA_AMIGA_ASYNC_DATASTORE'))
+        with startup_trace.phase('db open'):
+            if self.async_datastore:
+                self.datastore = AsyncDatastore(database_path(), dispatch=GLib.idle_add,
+                                                changed_callback=self.datastore_changed)
+            else:
+                self.datastore = Datastore(database_path())
+
+        # when the daemon is collecting sips the app only shows what it saves
+        self.ingest_lock = IngestLock(ingest_lock_path())
+        if self.ingest_lock.acquire():
+            self.journal = SipJournal(journal_path())
+            self.ingest = SipIngest(self.datastore, self.journal)
+            with startup_trace.phase('journal replay'):
+                self.ingest.replay_sip_journal()
+
+            if os.environ.get('AGUA_AMIGA_BLUETOOTH') == 'asyncio':
+                # only loaded when asked for, it needs a newer PyGObject
+                from agua_amiga.aio_bluetooth import AioBluetoothScanner, install_glib_event_loop_policy
+                install_glib_event_loop_policy()
+                scanner_class = AioBluetoothScanner
+            else:
+                scanner_class = BluetoothScanner
+
+            # only sets up, connecting to bluez happens once the main loop runs
+            with startup_trace.phase('scanner init'):
+                self.scanner = scanner_class(self.bluetooth_status_update, self.devices_update, self.update, self.journal,
+                                             DeviceRegistry.load(devices_config_path()))
+
+            self.metrics_exporter = metrics.start_exporter()
+        else:
+            self.journal = None
+            self.scanner = None
+            self.metrics_exporter = None
+            self.database_monitors = self.watch_database()
 
         Notify.init("Agua Amiga")
         self.notification = Notify.Notification()
+        self.reminders = ReminderScheduler(self.datastore, self.remind_to_drink, self.notification.close)
 
         self.connect('shutdown', self.on_quit)
 
         style_provider = Gtk.CssProvider()
-        style_provider.load_from_path("styles.css")
+        with startup_trace.phase('css'):
+            load_css(style_provider)
 
         Gtk.StyleContext.add_provider_for_screen(
             Gdk.Screen.get_default(),
@@ -41,64 +78,92 @@ class Application(Gtk.Application):
 
     def update(self):
         if self.window and self.scanner:
-            have_updates = len(self.scanner.sip_stream)
-
-            while len(self.scanner.sip_stream):
-                sip = self.scanner.sip_stream.pop()
-                self.datastore.save_sip(*sip)
+            # the async datastore calls datastore_changed once the sips are committed
+            if self.save_queued_sips() and not self.async_datastore:
+                self.datastore_changed()
+
+    def save_queued_sips(self):
+        return self.ingest.save_queued_sips(self.scanner.sip_stream)
+
+    def watch_database(self):
+        """
+        follows the daemon's writes. SQLite in WAL mode appends commits to the -wal file,
+        and checkpoints write the db file itself.
+        """
+        monitors = []
+        for path in [database_path(), database_path() + '-wal']:
+            monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            monitor.set_rate_limit(500)
+            monitor.connect('changed', self.database_file_changed)
+            monitors.append(monitor)
+
+        return monitors
+
+    def database_file_changed(self, monitor, file, other_file, event_type):
+        if event_type in (Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CREATED) \
+                and self.datastore.refresh_external_changes():
+            self.datastore_changed()
+
+    def datastore_changed(self):
+        if self.window:
+            started = time.perf_counter() if metrics.ENABLED else None
+            self.window.update_goal_progress_bar()
+            if started is not None:
+                metrics.UI_REFRESH_SECONDS.observe_since(started)
 
-            if have_updates:
-                self.window.update_goal_progress_bar()
+    def do_activate(self):
+        if self.window is None:
+            with startup_trace.phase('main window'):
+                self.window = MainWindow(application=self, datastore=self.datastore,
+                                         settings_changed_callback=self.reminders.plan)
 
-        return True  # so this method keeps getting called from the timeout
+            if self.scanner:
+                # until the scanner reports ENABLED or DISABLED after connecting to bluez
+                self.window.mark_bluetooth_connecting()
 
-    def do_activate(self):
-        self.window = self.window or MainWindow(application=self, datastore=self.datastore)
         self.window.ensure_goal_set()
         self.window.update_goal_progress_bar()
-        self.scanner.start_scanner()
+        if self.scanner:
+            self.scanner.start_scanner()
+            # sips that arrived before the window existed are still queued
+            self.update()
 
-        GLib.timeout_add_seconds(5, self.update)
-        GLib.timeout_add_seconds(timedelta(hours=1).seconds, self.remind_to_drink)
+        # planned again as sips come in, see ReminderScheduler
+        self.reminders.start()
 
         self.window.present()
+        startup_trace.mark('window presented')
 
     def on_quit(self, widget=None):
-        self.scanner.close()
-
-    def remind_to_drink(self):
-        volume_drunk = self.datastore.get_volume_drunk_today()
-        goal_volume = self.datastore.get_daily_goal_volume()
+        self.reminders.stop()
 
-        # want to notify user if not keeping up with their goal
-        # say a sliding window where they get a notification if
-        # the percentage of the day completed is 10 percentage points
-        # greater than the percentage of the goal drank
+        if self.scanner:
+            self.scanner.close()
 
-        # define the day as starting at 09:00 and ending at 21:00
+            # write out anything still queued before the process goes away
+            self.save_queued_sips()
+            self.journal.close()
+            self.ingest_lock.release()
 
-        hours_in_day = 12
-        start_hour = 6
-        end_hour = start_hour + hours_in_day
-        current_time = datetime.now()
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+            print(metrics.summary())
 
-        day_percentage = (current_time - timedelta(hours=start_hour)).hour / hours_in_day
-        goal_percentage = volume_drunk / goal_volume
-
-        if volume_drunk < goal_volume and day_percentage > goal_percentage:
-            self.notification.update("Hey, you should drink some water!",
-                                     f"You have drunk {goal_percentage:.2%} of your goal for today.")
-            self.notification.show()
-        else:
-            self.notification.close()
+        self.datastore.close()
 
-        return True
+    def remind_to_drink(self, goal_fraction):
+        self.notification.update("Hey, you should drink some water!",
+                                 f"You have drunk {goal_fraction:.2%} of your goal for today.")
+        self.notification.show()
 
     def bluetooth_status_update(self, status: BluetoothStatus, data):
         if self.window is None:
             return False
 
-        if status == BluetoothStatus.ENABLED:
+        if status == BluetoothStatus.CONNECTING:
+            self.window.mark_bluetooth_connecting()
+        elif status == BluetoothStatus.ENABLED:
             self.window.mark_bluetooth_enabled()
         elif status == BluetoothStatus.DISABLED:
             self.window.mark_bluetooth_disabled()
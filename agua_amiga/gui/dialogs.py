@@ -1,11 +1,13 @@
 import gi
 
-from agua_amiga.datastore import Unit
+from agua_amiga.datastore import DEFAULT_WAKING_HOURS, Unit
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 
+from .resources import template
 
-@Gtk.Template.from_file("ui_definitions/AddWaterDialog.glade")
+
+@template("AddWaterDialog.glade")
 class AddWaterDialog(Gtk.Dialog):
     __gtype_name__ = "AddWaterDialog"
 
@@ -28,13 +30,15 @@ class AddWaterDialog(Gtk.Dialog):
         return self.spin_button_add_water.get_value()
 
 
-@Gtk.Template.from_file("ui_definitions/Preferences.glade")
+@template("Preferences.glade")
 class PreferencesDialog(Gtk.Dialog):
     __gtype_name__ = "PreferencesDialog"
 
     spin_button_goal_volume: Gtk.SpinButton = Gtk.Template.Child()
     radio_display_units_oz: Gtk.RadioButton = Gtk.Template.Child()
     radio_display_units_ml: Gtk.RadioButton = Gtk.Template.Child()
+    spin_button_waking_start: Gtk.SpinButton = Gtk.Template.Child()
+    spin_button_waking_end: Gtk.SpinButton = Gtk.Template.Child()
 
     def __init__(self, *args, **kwargs) -> None:
         if 'units' in kwargs.keys():
@@ -49,6 +53,12 @@ class PreferencesDialog(Gtk.Dialog):
         else:
             goal_volume = 0
 
+        if 'waking_hours' in kwargs.keys():
+            waking_hours = kwargs['waking_hours']
+            del kwargs['waking_hours']
+        else:
+            waking_hours = DEFAULT_WAKING_HOURS
+
         super().__init__(*args, **kwargs)
 
         self.radio_display_units_oz.set_active(False)
@@ -61,6 +71,8 @@ class PreferencesDialog(Gtk.Dialog):
             self.radio_display_units_ml.set_active(True)
 
         self.spin_button_goal_volume.set_value(goal_volume)
+        self.spin_button_waking_start.set_value(waking_hours[0])
+        self.spin_button_waking_end.set_value(waking_hours[1])
 
 
     def get_display_units(self) -> Unit:
@@ -70,4 +82,11 @@ class PreferencesDialog(Gtk.Dialog):
         return Unit.ML
 
     def get_goal_volume(self):
-        return self.spin_button_goal_volume.get_value()
\ No newline at end of file
+        return self.spin_button_goal_volume.get_value()
+
+    def get_waking_hours(self):
+        start_hour = self.spin_button_waking_start.get_value_as_int()
+        end_hour = self.spin_button_waking_end.get_value_as_int()
+
+        # the window can't end before it starts, keep at least an hour of it
+        return start_hour, max(end_hour, start_hour + 1)
\ No newline at end of file
@@ -1,11 +1,13 @@
 from gi.repository import GLib, Gio, Gtk
 from datetime import datetime
-from agua_amiga.datastore import Datastore, convert_from_display_to_mL, convert_from_mL_to_display
-from .dialogs import AddWaterDialog, PreferencesDialog
-from .streak_window import StreakWindow
+from agua_amiga.datastore import Datastore, DayTotalsCache, convert_from_display_to_mL, convert_from_mL_to_display
+from agua_amiga.export import EXTENSIONS, ExportError, export
+from .resources import template
 
 
-@Gtk.Template.from_file("ui_definitions/MainWindow.glade")
+# the dialogs and the streak window are imported when first opened,
+# most sessions never open them and their templates don't need loading
+@template("MainWindow.glade")
 class MainWindow(Gtk.ApplicationWindow):
     __gtype_name__ = "MainWindow"
 
@@ -20,15 +22,22 @@ class MainWindow(Gtk.ApplicationWindow):
         self.datastore: Datastore = kwargs['datastore']
         del kwargs['datastore']
 
+        # called after preferences are saved, so reminders can be planned again
+        self.settings_changed_callback = kwargs.pop('settings_changed_callback', None)
+
         super().__init__(*args, **kwargs)
 
         self.list_devices.hide()
 
         self.streak_window = None
+        # kept across streak windows so paging back through history doesn't re-query
+        self.day_totals = DayTotalsCache(self.datastore)
 
     @Gtk.Template.Callback()
     def button_add_water_clicked_cb(self, widget, **_kwargs):
         assert self.button_add_water == widget
+        from .dialogs import AddWaterDialog
+
         display_units = self.datastore.get_display_units()
         dialog = AddWaterDialog(units=display_units)
 
@@ -52,15 +61,44 @@ class MainWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def button_display_streak_clicked_cb(self, widget, **_kwargs):
+            from .streak_window import StreakWindow
+
             self.button_display_streak.set_sensitive(False)
-            streak_window = StreakWindow(datastore = self.datastore)
+            streak_window = StreakWindow(datastore=self.datastore, day_totals=self.day_totals)
             streak_window.connect('destroy', self.streak_window_destroy_cb)
             streak_window.show()
 
+    @Gtk.Template.Callback()
+    def button_export_clicked_cb(self, widget, **_kwargs):
+        dialog = Gtk.FileChooserDialog(title="Export Water Data", parent=self, action=Gtk.FileChooserAction.SAVE)
+        dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_SAVE, Gtk.ResponseType.ACCEPT)
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name(f"water-{datetime.now():%Y-%m-%d}.csv")
+
+        for extension in EXTENSIONS:
+            file_filter = Gtk.FileFilter()
+            file_filter.set_name(extension)
+            file_filter.add_pattern(f"*{extension}")
+            dialog.add_filter(file_filter)
+
+        if dialog.run() == Gtk.ResponseType.ACCEPT:
+            try:
+                export(self.datastore, dialog.get_filename())
+            except (ExportError, OSError) as e:
+                error_dialog = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.ERROR,
+                                                 buttons=Gtk.ButtonsType.CLOSE, text="Couldn't export water data")
+                error_dialog.format_secondary_text(str(e))
+                error_dialog.run()
+                error_dialog.destroy()
+
+        dialog.destroy()
+
     def show_preferences_dialog(self):
+        from .dialogs import PreferencesDialog
+
         display_units = self.datastore.get_display_units()
         dialog = PreferencesDialog(units=display_units, goal_volume=convert_from_mL_to_display(
-            self.datastore.get_daily_goal_volume(), display_units))
+            self.datastore.get_daily_goal_volume(), display_units), waking_hours=self.datastore.get_waking_hours())
         response = dialog.run()
 
         if response == Gtk.ResponseType.APPLY and self.datastore is not None:
@@ -68,6 +106,9 @@ class MainWindow(Gtk.ApplicationWindow):
             self.datastore.set_display_units(display_units)
             self.datastore.set_daily_goal_volume(
                 convert_from_display_to_mL(dialog.get_goal_volume(), display_units))
+            self.datastore.set_waking_hours(*dialog.get_waking_hours())
+            if self.settings_changed_callback:
+                self.settings_changed_callback()
 
 
         dialog.destroy()
@@ -102,6 +143,16 @@ class MainWindow(Gtk.ApplicationWindow):
         self.clear_device_list()
         self.list_devices.show_all()
 
+    def mark_bluetooth_connecting(self):
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6, halign=Gtk.Align.CENTER)
+        spinner = Gtk.Spinner()
+        spinner.start()
+        box.add(spinner)
+        box.add(Gtk.Label(label="Connecting to Bluetooth"))
+        box.show_all()
+        self.list_devices.set_placeholder(box)
+        self.list_devices.show_all()
+
     def mark_bluetooth_enabled(self):
         self.list_devices.set_placeholder(self.box_devices_searching_placeholder)
         self.list_devices.show_all()
@@ -0,0 +1,43 @@
+"""
+the UI templates and styles.css, read from one GResource bundle built by `make resources`.
+
+The bundle is memory mapped, so templates are read out of it instead of opening each file.
+Without a bundle, or with AGUA_AMIGA_UI_FROM_FILES set (handy while editing the glade files),
+they are read from ui_definitions/ and styles.css in the working directory like before.
+"""
+import os
+import os.path
+
+from gi.repository import Gio, Gtk
+
+RESOURCE_PREFIX = '/me/rehack/agua_amiga'
+BUNDLE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'agua_amiga.gresource')
+
+
+def _register_bundle():
+    if os.environ.get('AGUA_AMIGA_UI_FROM_FILES') or not os.path.exists(BUNDLE_PATH):
+        return False
+
+    Gio.resources_register(Gio.Resource.load(BUNDLE_PATH))
+    return True
+
+
+# templates are attached when their class is defined, so this has to happen at import
+USE_BUNDLE = _register_bundle()
+
+
+def template(glade_file):
+    """
+    class decorator for the template in ui_definitions/<glade_file>
+    """
+    if USE_BUNDLE:
+        return Gtk.Template.from_resource(f"{RESOURCE_PREFIX}/ui_definitions/{glade_file}")
+
+    return Gtk.Template.from_file(f"ui_definitions/{glade_file}")
+
+
+def load_css(style_provider: Gtk.CssProvider):
+    if USE_BUNDLE:
+        style_provider.load_from_resource(f"{RESOURCE_PREFIX}/styles.css")
+    else:
+        style_provider.load_from_path("styles.css")
@@ -0,0 +1,115 @@
+"""
+saving the sips bottles report, shared by the app and the headless daemon.
+
+Only one process collects sips at a time, the one holding the ingest lock. Both would
+otherwise connect to the same bottles and write the same journal. The other process
+only reads the database.
+"""
+import fcntl
+import time
+
+from gi.repository import GLib
+
+from agua_amiga import metrics
+from agua_amiga.datastore import AsyncDatastore
+from agua_amiga.sip_journal import SipJournal
+
+
+class IngestLock:
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.file = None
+
+    def acquire(self) -> bool:
+        """
+        returns False if another process is collecting sips. The lock goes away with the process holding it,
+        even if it crashes.
+        """
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self.file = lock_file
+        return True
+
+    def release(self):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+class SipIngest:
+    """
+    moves sips from a scanner's SipStream into the datastore, and keeps the SipJournal in step with what's saved
+    """
+
+    def __init__(self, datastore, journal: SipJournal) -> None:
+        self.datastore = datastore
+        self.journal = journal
+        self.async_datastore = isinstance(datastore, AsyncDatastore)
+
+    def save_queued_sips(self, sip_stream):
+        sips = []
+
+        while len(sip_stream):
+            sips.append(sip_stream.pop())
+
+        if sips:
+            queued_at = self._sips_taken(sip_stream, len(sips)) if metrics.ENABLED else None
+
+            # everything queued has been journaled, so the newest record covers all of it
+            journal_seq = self.journal.last_seq
+            saved = self.datastore.save_sips(sips, journal_seq)
+
+            if self.async_datastore:
+                def _discard_journaled():
+                    if queued_at:
+                        self._sips_saved(queued_at)
+                    self.journal.discard_through(journal_seq)
+                    return False
+
+                # the future is done on the writer thread, the journal and metrics are only touched on the main loop
+                saved.add_done_callback(lambda future: future.exception() is None and GLib.idle_add(_discard_journaled))
+            else:
+                if queued_at:
+                    self._sips_saved(queued_at)
+                self.journal.discard_through(journal_seq)
+
+        return len(sips)
+
+    @staticmethod
+    def _sips_taken(sip_stream, count):
+        queued_at = sip_stream.take_queued_at(count)
+        now = time.perf_counter()
+        for queued in queued_at:
+            metrics.SIP_QUEUE_WAIT_SECONDS.observe(now - queued)
+
+        return queued_at
+
+    @staticmethod
+    def _sips_saved(queued_at):
+        now = time.perf_counter()
+        for queued in queued_at:
+            metrics.SIP_LATENCY_SECONDS.observe(now - queued)
+
+        metrics.SIPS_SAVED.inc(len(queued_at))
+
+    def replay_sip_journal(self):
+        """
+        saves sips that were journaled but not stored when the app last stopped
+        """
+        committed_seq = self.datastore.get_journal_committed_seq()
+        records = self.journal.records_after(committed_seq)
+
+        if records:
+            committed_seq = records[-1][0]
+            saved = self.datastore.save_sips([sip for _, sip in records], committed_seq)
+            if self.async_datastore:
+                saved.result()
+
+        self.journal.discard_through(committed_seq)
@@ -0,0 +1,224 @@
+"""
+where the time goes between a bottle sending a sip and the sip being saved.
+
+Set AGUA_AMIGA_METRICS to turn it on. Its value says where the metrics go, in Prometheus' text format:
+
+    AGUA_AMIGA_METRICS=/path/agua_amiga.prom       rewritten every DUMP_INTERVAL_S, e.g. for node_exporter's
+                                                   textfile collector
+    AGUA_AMIGA_METRICS=unix:/path/metrics.sock     written to whoever connects, e.g. socat - UNIX-CONNECT:/path/metrics.sock
+
+When it isn't set the metrics below still exist but nothing observes them. Code on the sip path checks
+ENABLED before even reading the clock, so instrumentation costs a global lookup per sip.
+
+The end to end latency (agua_amiga_sip_latency_seconds) runs from a sip being queued by the bottle's
+notification handler to the transaction with it committing.
+"""
+import bisect
+import os
+import socket
+import threading
+import time
+
+ENABLED = bool(os.environ.get('AGUA_AMIGA_METRICS'))
+
+DUMP_INTERVAL_S = 15
+
+# 100µs to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# LE connects with service discovery take seconds, and BlueZ gives up on them after about 30
+CONNECT_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60)
+
+REGISTRY = []
+
+
+class Counter:
+
+    def __init__(self, name, help) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+        REGISTRY.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Histogram:
+    """
+    counts observations into fixed buckets, like a Prometheus histogram. Observations can come from any thread.
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # one more than buckets, for observations above the largest
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_since(self, started):
+        """
+        observes the time since started, a time.perf_counter() reading
+        """
+        self.observe(time.perf_counter() - started)
+
+    def quantile(self, q):
+        """
+        estimates the q quantile the way Prometheus' histogram_quantile does, None before anything is observed
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+
+                lower = self.buckets[index - 1] if index else 0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+
+            cumulative += count
+
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+DBUS_CALL_SECONDS = Histogram('agua_amiga_dbus_call_seconds', "time from a D-Bus call to its reply")
+SIP_NOTIFICATION_SECONDS = Histogram('agua_amiga_sip_notification_seconds', "time spent handling a sip notification")
+SIP_QUEUE_WAIT_SECONDS = Histogram('agua_amiga_sip_queue_wait_seconds', "time sips wait in the sip stream to be saved")
+SIP_SAVE_SECONDS = Histogram('agua_amiga_sip_save_seconds', "time the transaction saving a batch of sips takes")
+SIP_LATENCY_SECONDS = Histogram('agua_amiga_sip_latency_seconds', "time from a sip being queued to it being saved")
+UI_REFRESH_SECONDS = Histogram('agua_amiga_ui_refresh_seconds', "time updating the main window after sips are saved")
+BOTTLE_CONNECT_SECONDS = Histogram('agua_amiga_bottle_connect_seconds', "time a successful bottle connect took once it started",
+                                   CONNECT_BUCKETS)
+
+SIPS_RECEIVED = Counter('agua_amiga_sips_received_total', "sips reported by bottles")
+SIPS_SAVED = Counter('agua_amiga_sips_saved_total', "sips saved to the database")
+DBUS_ERRORS = Counter('agua_amiga_dbus_errors_total', "D-Bus calls that failed")
+BUS_CONNECT_RETRIES = Counter('agua_amiga_bus_connect_retries_total', "times connecting to the system bus was retried")
+BOTTLE_CONNECT_RETRIES = Counter('agua_amiga_bottle_connect_retries_total', "times connecting to a bottle was retried")
+
+
+def render():
+    """
+    every metric in Prometheus' text exposition format
+    """
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def summary():
+    p50, p99 = SIP_LATENCY_SECONDS.quantile(0.5), SIP_LATENCY_SECONDS.quantile(0.99)
+    if p50 is None:
+        return "no sips saved"
+
+    return f"{SIPS_SAVED.value} sips saved, latency p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms"
+
+
+class MetricsExporter:
+    """
+    writes the metrics to a file every DUMP_INTERVAL_S, or to clients of a Unix socket, from the GLib main loop
+    """
+
+    def __init__(self, target) -> None:
+        self.target = target
+        self.socket = None
+        self._source_id = None
+
+    def start(self):
+        # only the processes collecting sips export, so other users of these metrics don't need GLib
+        from gi.repository import GLib
+
+        if self.target.startswith('unix:'):
+            path = self.target[len('unix:'):]
+            if os.path.exists(path):
+                os.unlink(path)
+
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(path)
+            self.socket.listen()
+            self.socket.setblocking(False)
+            self._source_id = GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IOCondition.IN,
+                                                self._client_connected)
+        else:
+            self._dump()
+            self._source_id = GLib.timeout_add_seconds(DUMP_INTERVAL_S, self._dump)
+
+        return self
+
+    def stop(self):
+        from gi.repository import GLib
+
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+        if self.socket:
+            path = self.socket.getsockname()
+            self.socket.close()
+            self.socket = None
+            os.unlink(path)
+        elif not self.target.startswith('unix:'):
+            # the last values before the process goes away
+            self._dump()
+
+    def _dump(self):
+        # written next to the target and renamed, so readers never see half a file
+        temporary_path = f"{self.target}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, 'w') as dump_file:
+                dump_file.write(render())
+            os.replace(temporary_path, self.target)
+        except OSError as e:
+            print(f"couldn't write metrics to {self.target}: {e}")
+
+        return True
+
+    def _client_connected(self, fd, condition):
+        try:
+            client, _ = self.socket.accept()
+        except BlockingIOError:
+            return True
+
+        with client:
+            try:
+                client.sendall(render().encode())
+            except OSError:
+                pass
+
+        return True
+
+
+def start_exporter():
+    """
+    starts exporting to where AGUA_AMIGA_METRICS says, returns the exporter or None when metrics are off
+    """
+    if not ENABLED:
+        return None
+
+    return MetricsExporter(os.environ['AGUA_AMIGA_METRICS']).start()
@@ -0,0 +1,36 @@
+import os.path
+
+from gi.repository import GLib
+
+DATABASE_NAME = "water.db"
+JOURNAL_NAME = "sips.journal"
+DEVICES_CONFIG_NAME = "devices.json"
+INGEST_LOCK_NAME = "ingest.lock"
+
+
+def user_data_path():
+    """
+    directory the app keeps its data in, created if it doesn't exist yet
+    """
+    data_path = os.path.join(GLib.get_user_data_dir(), 'agua_amiga')
+
+    if not os.path.exists(data_path):
+        os.mkdir(data_path)
+
+    return data_path
+
+
+def database_path():
+    return os.path.join(user_data_path(), DATABASE_NAME)
+
+
+def journal_path():
+    return os.path.join(user_data_path(), JOURNAL_NAME)
+
+
+def ingest_lock_path():
+    return os.path.join(user_data_path(), INGEST_LOCK_NAME)
+
+
+def devices_config_path():
+    return os.path.join(GLib.get_user_config_dir(), 'agua_amiga', DEVICES_CONFIG_NAME)
@@ -0,0 +1,124 @@
+"""
+reminds the user to drink when they fall behind pace for their goal.
+
+The pace is an even share of the goal across the waking hours, and falling behind means
+having drunk PACE_SLACK of the goal less than that. From today's total that moment can be
+worked out exactly, so a single timer is set for it instead of checking every hour. It is
+planned again whenever sips are saved for today, and after each reminder.
+"""
+import math
+from datetime import datetime, time, timedelta
+
+from gi.repository import GLib
+
+from agua_amiga.datastore import day_key
+
+PACE_SLACK = 0.1
+
+# how often to remind while the user stays behind
+REMIND_INTERVAL = timedelta(hours=1)
+
+
+def behind_pace_at(now: datetime, volume_drunk, goal_volume, waking_hours):
+    """
+    when the user falls behind pace today if they drink nothing more, None if that won't happen
+    before the waking hours end. Can be before now, if they are already behind.
+    """
+    start_hour, end_hour = waking_hours
+    start = datetime.combine(now.date(), time(start_hour))
+    end = datetime.combine(now.date(), time()) + timedelta(hours=end_hour)
+
+    if goal_volume <= 0 or now >= end or end <= start:
+        return None
+
+    fraction_of_day = volume_drunk / goal_volume + PACE_SLACK
+    if fraction_of_day >= 1:
+        return None
+
+    return start + (end - start) * fraction_of_day
+
+
+class ReminderScheduler:
+    """
+    calls remind_callback(fraction of the goal drunk) when the user is behind pace,
+    and caught_up_callback() when a plan finds they aren't anymore
+    """
+
+    def __init__(self, datastore, remind_callback, caught_up_callback) -> None:
+        self.datastore = datastore
+        self.remind_callback = remind_callback
+        self.caught_up_callback = caught_up_callback
+
+        self.remind_at = None
+        self.last_reminder = None
+        self.started = False
+        self._timeout_id = None
+
+    def start(self):
+        if not self.started:
+            self.datastore.add_days_listener(self._days_saved)
+            self.started = True
+
+        self.plan()
+
+    def stop(self):
+        if self.started:
+            self.datastore.remove_days_listener(self._days_saved)
+            self.started = False
+
+        self._cancel_timeout()
+
+    def plan(self):
+        """
+        sets the timer for the next moment the user would be behind pace, call when the goal or waking hours change
+        """
+        now = datetime.now()
+        goal_volume = self.datastore.get_daily_goal_volume()
+        remind_at = behind_pace_at(now, self.datastore.get_volume_drunk_today(), goal_volume,
+                                   self.datastore.get_waking_hours())
+
+        if remind_at is None:
+            # on pace for the rest of today, tomorrow starts from nothing
+            tomorrow = datetime.combine(now.date() + timedelta(days=1), time())
+            remind_at = behind_pace_at(tomorrow, 0, goal_volume, self.datastore.get_waking_hours())
+
+        if remind_at is None or remind_at > now:
+            self.caught_up_callback()
+
+        if remind_at is not None and self.last_reminder is not None:
+            remind_at = max(remind_at, self.last_reminder + REMIND_INTERVAL)
+
+        self._set_timeout(remind_at, now)
+
+    def _days_saved(self, days):
+        if day_key(datetime.now()) in days:
+            self.plan()
+
+    def _remind(self):
+        self._timeout_id = None
+
+        now = datetime.now()
+        volume_drunk = self.datastore.get_volume_drunk_today()
+        goal_volume = self.datastore.get_daily_goal_volume()
+        remind_at = behind_pace_at(now, volume_drunk, goal_volume, self.datastore.get_waking_hours())
+
+        # the plan can be stale, e.g. after a suspend, so check again
+        if remind_at is not None and remind_at <= now:
+            self.last_reminder = now
+            self.remind_callback(volume_drunk / goal_volume)
+
+        self.plan()
+        return False
+
+    def _set_timeout(self, remind_at, now):
+        self._cancel_timeout()
+        self.remind_at = remind_at
+
+        if remind_at is not None:
+            delay = max(math.ceil((remind_at - now).total_seconds()), 0)
+            self._timeout_id = GLib.timeout_add_seconds(delay, self._remind)
+
+    def _cancel_timeout(self):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
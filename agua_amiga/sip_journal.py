@@ -0,0 +1,123 @@
+"""
+append-only journal that sips are written to as soon as a bottle reports them,
+before the bottle is told to forget them.
+
+The journal is a memory mapped file of fixed size records. Appending is a struct.pack_into
+into the map, there is no system call, but the data is in the page cache and is written out
+by the kernel even if the app crashes right after. Every record has a sequence number,
+the Datastore saves the last sequence number it has stored in the same transaction as the sips.
+On startup, records newer than that are saved again, and once everything in the journal is
+in sqlite the journal is emptied.
+
+This protects sips against the app crashing or being killed, not against losing power. Neither appends
+nor discarding are msynced, and with synchronous=NORMAL the sqlite commit a discard follows isn't
+on disk yet either, so both sides are equally as durable as the page cache.
+"""
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime
+
+MAGIC = b'AGUAJRNL'
+VERSION = 1
+
+# magic, version, record size, next sequence number, record count
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_SIZE = 64
+
+# sequence number, timestamp, volume, source, crc32 of the preceding fields
+RECORD = struct.Struct('<Qdd32sI4x')
+RECORD_SIZE = RECORD.size
+RECORD_CRC_OFFSET = RECORD_SIZE - 8
+
+INITIAL_CAPACITY = 1024
+
+
+class JournalCorrupted(Exception):
+    pass
+
+
+class SipJournal:
+
+    def __init__(self, path, initial_capacity=INITIAL_CAPACITY) -> None:
+        self.path = path
+        self.file = open(path, 'a+b')
+
+        if os.fstat(self.file.fileno()).st_size < HEADER_SIZE:
+            self.file.truncate(HEADER_SIZE + initial_capacity * RECORD_SIZE)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD_SIZE, 1, 0)
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+        magic, version, record_size, self.next_seq, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            raise JournalCorrupted(f"{path} is not a sip journal this version can read")
+
+    @property
+    def last_seq(self):
+        """
+        sequence number of the newest record, 0 if nothing was ever appended
+        """
+        return self.next_seq - 1
+
+    def append(self, volume, time: datetime, source) -> int:
+        """
+        writes a sip to the journal and returns its sequence number
+        """
+        offset = HEADER_SIZE + self.count * RECORD_SIZE
+        if offset + RECORD_SIZE > len(self.map):
+            self._grow()
+
+        seq = self.next_seq
+        RECORD.pack_into(self.map, offset, seq, time.timestamp(), volume, source.encode()[:32], 0)
+        struct.pack_into('<I', self.map, offset + RECORD_CRC_OFFSET,
+                         zlib.crc32(self.map[offset:offset + RECORD_CRC_OFFSET]))
+
+        # the record is only counted once it is complete
+        self.next_seq += 1
+        self.count += 1
+        self._write_header()
+
+        return seq
+
+    def records_after(self, seq):
+        """
+        returns [(seq, (volume, time, source))] for the records newer than seq, oldest first.
+        A record with a bad checksum ends the journal, it was being written when the app died.
+        """
+        records = []
+        for index in range(self.count):
+            offset = HEADER_SIZE + index * RECORD_SIZE
+            record_seq, timestamp, volume, source, crc = RECORD.unpack_from(self.map, offset)
+            if crc != zlib.crc32(self.map[offset:offset + RECORD_CRC_OFFSET]):
+                break
+
+            if record_seq > seq:
+                records.append((record_seq, (volume, datetime.fromtimestamp(timestamp), source.rstrip(b'\0').decode(errors='ignore'))))
+
+        return records
+
+    def discard_through(self, seq):
+        """
+        called once every record up to seq is stored elsewhere. The journal is emptied when that is all of it,
+        sequence numbers keep counting up.
+        """
+        if seq >= self.last_seq and self.count:
+            self.count = 0
+            self._write_header()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD_SIZE, self.next_seq, self.count)
+
+    def _grow(self):
+        size = len(self.map)
+        self.map.close()
+        self.file.truncate(HEADER_SIZE + (size - HEADER_SIZE) * 2)
+        self.map = mmap.mmap(self.file.fileno(), 0)
@@ -0,0 +1,38 @@
+"""
+timing of the phases of starting up, printed to stderr when AGUA_AMIGA_TRACE_STARTUP is set.
+
+    with startup_trace.phase('db open'):       a synchronous step, prints how long it took
+        ...
+    startup_trace.mark('bus connected')        an asynchronous step finishing, prints when it happened
+
+Times are from when agua_amiga was first imported. When tracing is off, both do nothing.
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+ENABLED = bool(os.environ.get('AGUA_AMIGA_TRACE_STARTUP'))
+
+_started = time.perf_counter()
+
+
+@contextmanager
+def phase(name):
+    if not ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        print(f"startup: {name:<20} {(end - start) * 1000:8.1f}ms, done at {(end - _started) * 1000:8.1f}ms",
+              file=sys.stderr)
+
+
+def mark(name):
+    if ENABLED:
+        print(f"startup: {name:<20} {'':>10}  done at {(time.perf_counter() - _started) * 1000:8.1f}ms",
+              file=sys.stderr)
@@ -0,0 +1,76 @@
+"""
+compares the numpy aggregates in agua_amiga.analytics with the same aggregates
+computed by looping over rows in python.
+
+run with: python benchmarks/analytics.py [number of sips]
+"""
+import os.path
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from agua_amiga import analytics
+from agua_amiga.datastore import Datastore
+
+
+def fill_datastore(datastore, count):
+    start = datetime.now() - timedelta(days=3 * 365)
+    step = (3 * 365 * 24 * 60) / count
+    sources = ['manual', 'h2o10C28', 'h2o20A11']
+    datastore.save_sips((random.uniform(5, 60), start + timedelta(minutes=i * step), random.choice(sources))
+                        for i in range(count))
+
+
+def python_aggregates(datastore):
+    rows = datastore.cursor.execute('SELECT time, volume, source FROM drinks ORDER BY ts').fetchall()
+
+    hours = [0.0] * 24
+    days = defaultdict(float)
+    sources = defaultdict(float)
+    for drink_time, volume, source in rows:
+        hours[drink_time.hour] += volume
+        days[drink_time.date()] += volume
+        sources[source] += volume
+
+    day = min(days)
+    totals = []
+    while day <= max(days):
+        totals.append(days.get(day, 0.0))
+        day += timedelta(days=1)
+
+    averages = [sum(totals[max(0, i - 6):i + 1]) / min(i + 1, 7) for i in range(len(totals))]
+
+    return hours, averages, dict(sources)
+
+
+def numpy_aggregates(datastore):
+    drinks = analytics.load_drinks(datastore)
+    return (analytics.hourly_histogram(drinks), analytics.rolling_average(drinks, 7)[1],
+            analytics.per_source_totals(drinks))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        datastore = Datastore(os.path.join(directory, 'analytics.db'))
+        fill_datastore(datastore, count)
+
+        for name, func in [('python loops', python_aggregates), ('numpy', numpy_aggregates)]:
+            print(f"{name:>12}: {count} sips in {timed(func, datastore):.3f}s")
+
+        drinks = analytics.load_drinks(datastore)
+        print(f"{'numpy only':>12}: {timed(lambda: (analytics.hourly_histogram(drinks), analytics.rolling_average(drinks, 7), analytics.per_source_totals(drinks))):.3f}s after the bulk read")
+
+
+if __name__ == '__main__':
+    main()
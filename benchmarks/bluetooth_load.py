@@ -0,0 +1,189 @@
+"""
+load test of the Bluetooth stack against benchmarks/fake_bluez.py, so scaling problems show up without bottles.
+
+    python benchmarks/bluetooth_load.py                   1, 10 and 100 bottles on BluetoothScanner
+    python benchmarks/bluetooth_load.py --asyncio         the same on AioBluetoothScanner
+    python benchmarks/bluetooth_load.py --bottles 10 --backlog 200 --max-concurrent 4
+
+Each number of bottles runs in a fresh process, with its own private dbus-daemon and a fake BlueZ on it.
+Every bottle holds --backlog stored sips. The run lasts until all of them have arrived, and prints:
+
+    found                   from starting the scanner to a bottle showing up in its devices, p50 and max
+    connect                 how long connecting a bottle took once its turn came, p50 and max
+    sips/s                  sips received per second, from the first bottle showing up to the last sip,
+                            including SipStream's coalescing delay
+    memory                  how much the process' peak RSS grew while the scanner ran
+
+Needs dbus-daemon.
+"""
+import argparse
+import asyncio
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from gi.repository import GLib
+
+from agua_amiga.bluetooth_scanner import BluetoothScanner, BluetoothStatus
+from agua_amiga.device_registry import DEFAULT_MAX_CONCURRENT_CONNECTS, DeviceFilter, DeviceRegistry
+
+# next to this file, which is on the path when it's run as a script
+import fake_bluez
+
+BOTTLE_COUNTS = [1, 10, 100]
+TIMEOUT_S = 300
+
+
+def start_private_bus():
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return daemon, daemon.stdout.readline().strip()
+
+
+def start_fake_bluez(address, bottles, backlog):
+    fake = subprocess.Popen([sys.executable, fake_bluez.__file__, '--address', address,
+                             '--bottles', str(bottles), '--backlog', str(backlog)], stdout=subprocess.PIPE, text=True)
+    if fake.stdout.readline().strip() != 'ready':
+        raise RuntimeError("fake BlueZ didn't start")
+
+    return fake
+
+
+class LoadRun:
+    """
+    a scanner on the fake BlueZ, done_callback is called once expected_sips arrived or the scanner failed.
+    Only the scanner's callbacks and its connect_latencies are used for timing.
+    """
+
+    def __init__(self, scanner_class, address, bottles, expected_sips, max_concurrent, done_callback) -> None:
+        registry = DeviceRegistry([DeviceFilter(address=fake_bluez.bottle_address(index)) for index in range(bottles)],
+                                  max_concurrent)
+        self.scanner = scanner_class(self.status_update, self.devices_update, self.sips_queued,
+                                     registry=registry, bus_address=address)
+        self.expected_sips = expected_sips
+        self.done_callback = done_callback
+        self.done = False
+
+        self.started = time.perf_counter()
+        self.sips = 0
+        self.found_at = {}
+        self.last_sip_at = None
+        self.error = None
+
+    @property
+    def connect_latencies(self):
+        # the promise scanner keeps them in its ConnectionScheduler
+        scheduler = getattr(self.scanner, 'connection_scheduler', None)
+        return (scheduler or self.scanner).connect_latencies
+
+    def finish(self):
+        # sips and errors keep coming while the scanner closes
+        if not self.done:
+            self.done = True
+            self.done_callback()
+
+    def status_update(self, status, data):
+        if status == BluetoothStatus.ERROR and not self.done:
+            self.error = data
+            self.finish()
+
+    def devices_update(self, devices):
+        now = time.perf_counter()
+        for path in devices:
+            self.found_at.setdefault(path, now - self.started)
+
+    def sips_queued(self):
+        while len(self.scanner.sip_stream):
+            self.scanner.sip_stream.pop()
+            self.sips += 1
+
+        self.last_sip_at = time.perf_counter()
+        if self.sips >= self.expected_sips:
+            self.finish()
+
+    def report(self, bottles, rss_growth_kb):
+        found = sorted(self.found_at.values())
+        connects = sorted(self.connect_latencies.values())
+        if self.error or self.sips < self.expected_sips or not connects:
+            print(f"{bottles:>4} bottles: incomplete, {len(connects)} connected, "
+                  f"{self.sips}/{self.expected_sips} sips{f', {self.error}' if self.error else ''}")
+            return
+
+        drain_s = self.last_sip_at - self.started - found[0]
+        print(f"{bottles:>4} bottles: found p50 {statistics.median(found) * 1000:7.1f}ms max {found[-1] * 1000:7.1f}ms, "
+              f"connect p50 {statistics.median(connects) * 1000:7.1f}ms max {connects[-1] * 1000:7.1f}ms, "
+              f"{self.sips} sips at {self.sips / drain_s:7.1f} sips/s, memory +{rss_growth_kb / 1024:.1f}MB")
+
+
+def run_promise(address, bottles, expected_sips, max_concurrent):
+    loop = GLib.MainLoop()
+    load = LoadRun(BluetoothScanner, address, bottles, expected_sips, max_concurrent, loop.quit)
+
+    load.scanner.start_scanner()
+    GLib.timeout_add_seconds(TIMEOUT_S, load.finish)
+    loop.run()
+
+    # closing runs on the main loop, it stops notifications and disconnects the bottles
+    load.scanner.close(loop.quit)
+    loop.run()
+
+    return load
+
+
+def run_asyncio(address, bottles, expected_sips, max_concurrent):
+    from agua_amiga.aio_bluetooth import AioBluetoothScanner, install_glib_event_loop_policy
+
+    install_glib_event_loop_policy()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    finished = loop.create_future()
+
+    load = LoadRun(AioBluetoothScanner, address, bottles, expected_sips, max_concurrent,
+                   lambda: finished.done() or finished.set_result(None))
+    load.scanner.start_scanner()
+    try:
+        loop.run_until_complete(asyncio.wait_for(finished, TIMEOUT_S))
+    except asyncio.TimeoutError:
+        pass
+    loop.run_until_complete(load.scanner.close())
+
+    return load
+
+
+def run(bottles, backlog, max_concurrent, use_asyncio):
+    daemon, address = start_private_bus()
+    fake = start_fake_bluez(address, bottles, backlog)
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        load = (run_asyncio if use_asyncio else run_promise)(address, bottles, bottles * backlog, max_concurrent)
+        rss_growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    finally:
+        fake.terminate()
+        daemon.terminate()
+
+    load.report(bottles, rss_growth_kb)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test of the Bluetooth stack against a fake BlueZ")
+    parser.add_argument('--bottles', type=int, nargs='+', default=BOTTLE_COUNTS)
+    parser.add_argument('--backlog', type=int, default=20, help="sips stored on each bottle")
+    parser.add_argument('--max-concurrent', type=int, default=DEFAULT_MAX_CONCURRENT_CONNECTS)
+    parser.add_argument('--asyncio', action='store_true', help="use AioBluetoothScanner")
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.bottles[0], args.backlog, args.max_concurrent, args.asyncio)
+        return
+
+    # a process per run, so memory and D-Bus state don't carry over
+    for bottles in args.bottles:
+        subprocess.run([sys.executable, __file__, '--run', '--bottles', str(bottles), '--backlog', str(args.backlog),
+                        '--max-concurrent', str(args.max_concurrent)] + (['--asyncio'] if args.asyncio else []))
+
+
+if __name__ == '__main__':
+    main()
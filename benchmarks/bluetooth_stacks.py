@@ -0,0 +1,102 @@
+"""
+compares the promise based BluetoothScanner with the asyncio based AioBluetoothScanner.
+
+    python benchmarks/bluetooth_stacks.py            per call overhead of wrapping a D-Bus call
+    python benchmarks/bluetooth_stacks.py --first-sip
+                                                     time from starting each scanner to the first sip,
+                                                     needs a bottle in range with a sip stored on it
+
+The call overhead measures only what each stack adds around a call, the fake method answers
+right away. Time to first sip includes SipStream's coalescing delay, which is the same for both.
+"""
+import asyncio
+import sys
+import time
+
+from gi.repository import GLib
+
+from agua_amiga.aio_bluetooth import AioBluetoothScanner, install_glib_event_loop_policy
+from agua_amiga.bluetooth_scanner import BluetoothScanner, dbus_callback_promise
+
+CALLS = 100_000
+
+
+def promise_call_overhead(calls):
+    def fake_method(callback):
+        callback([True], None)
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        dbus_callback_promise(fake_method).then(lambda result: result[0])
+
+    return time.perf_counter() - start
+
+
+def asyncio_call_overhead(calls):
+    async def fake_method():
+        reply = asyncio.get_running_loop().create_future()
+        reply.set_result(True)
+        return await reply
+
+    async def run():
+        start = time.perf_counter()
+        for _ in range(calls):
+            await fake_method()
+
+        return time.perf_counter() - start
+
+    return asyncio.run(run())
+
+
+def promise_time_to_first_sip():
+    loop = GLib.MainLoop()
+    first_sip = []
+
+    def sips_queued():
+        # later sips could otherwise stop the loop while the scanner is closing
+        if not first_sip:
+            first_sip.append(time.perf_counter())
+            loop.quit()
+
+    start = time.perf_counter()
+    scanner = BluetoothScanner(lambda *_: None, lambda *_: None, sips_queued)
+    scanner.start_scanner()
+    loop.run()
+    elapsed = first_sip[0] - start
+
+    # closing runs on the main loop, it stops notifications and disconnects the bottle
+    scanner.close(loop.quit)
+    loop.run()
+
+    return elapsed
+
+
+def asyncio_time_to_first_sip():
+    install_glib_event_loop_policy()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    first_sip = loop.create_future()
+
+    start = time.perf_counter()
+    scanner = AioBluetoothScanner(lambda *_: None, lambda *_: None, lambda: first_sip.done() or first_sip.set_result(None))
+    scanner.start_scanner()
+    loop.run_until_complete(first_sip)
+    elapsed = time.perf_counter() - start
+    loop.run_until_complete(scanner.close())
+
+    return elapsed
+
+
+def main():
+    if '--first-sip' in sys.argv:
+        print(f" promise: first sip after {promise_time_to_first_sip():.3f}s")
+        print(f" asyncio: first sip after {asyncio_time_to_first_sip():.3f}s")
+        return
+
+    for name, bench in [('promise', promise_call_overhead), ('asyncio', asyncio_call_overhead)]:
+        elapsed = bench(CALLS)
+        print(f"{name:>8}: {elapsed / CALLS * 1e6:.2f}us per call")
+
+
+if __name__ == '__main__':
+    main()
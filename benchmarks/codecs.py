@@ -0,0 +1,71 @@
+"""
+checks every bottle codec against its golden payloads, then times decoding.
+
+run with: python benchmarks/codecs.py [number of payloads]
+
+Exits with an error if a codec decodes a golden payload differently. The Hidrate Spark 3 codec
+is also compared with the slicing parser WaterBottle used before codecs existed.
+"""
+import sys
+import time
+
+from agua_amiga.bottle_codecs import CODECS, HidrateSpark3Codec
+
+
+def slicing_parse_sip(data):
+    """
+    the parser WaterBottle had before the codecs, for comparison
+    """
+    no_sips_left_on_device = data[0]
+    b2 = data[1] & 255
+    SipSize = (HidrateSpark3Codec.bottle_size * b2) / 100
+    total = int.from_bytes(data[3:1:-1], "little") & 65535
+    secondsAgo = int.from_bytes(data[8:4:-1], "little") & -1
+
+    return SipSize, total, secondsAgo, no_sips_left_on_device
+
+
+def check_golden_payloads():
+    failures = 0
+    for model, codec in CODECS.items():
+        for payload, expected in codec.golden_payloads:
+            for decoded in [codec.decode(payload), codec.decode(memoryview(payload)), codec.decode_batch([payload])[0]]:
+                if decoded != expected:
+                    print(f"{model}: {payload.hex()} decoded to {decoded}, expected {expected}")
+                    failures += 1
+
+    for payload, expected in HidrateSpark3Codec.golden_payloads:
+        if tuple(slicing_parse_sip(payload)) != tuple(expected):
+            print(f"slicing parser disagrees on {payload.hex()}")
+            failures += 1
+
+    return failures
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    if check_golden_payloads():
+        sys.exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    for model, codec in CODECS.items():
+        payloads = [payload for payload, _ in codec.golden_payloads] * (count // len(codec.golden_payloads))
+
+        single = timed(lambda: [codec.decode(payload) for payload in payloads])
+        batch = timed(codec.decode_batch, payloads)
+        print(f"{model}: decode {single / len(payloads) * 1e9:.0f}ns, "
+              f"decode_batch {batch / len(payloads) * 1e9:.0f}ns per payload")
+
+        if codec.model == HidrateSpark3Codec.model:
+            slicing = timed(lambda: [slicing_parse_sip(payload) for payload in payloads])
+            print(f"{'slicing parser':>{len(model)}}: {slicing / len(payloads) * 1e9:.0f}ns per payload")
+
+
+if __name__ == '__main__':
+    main()
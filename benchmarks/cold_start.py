@@ -0,0 +1,63 @@
+"""
+cold start of the UI, with templates read from the GResource bundle vs from the glade files.
+
+run from the repo root after `make resources`: python benchmarks/cold_start.py [runs]
+
+Each run is a fresh interpreter that imports the app and builds the main window, needs a display.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+RUN = """
+import time
+start = time.perf_counter()
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk
+from agua_amiga.datastore import Datastore
+from agua_amiga.gui.application import Application
+from agua_amiga.gui.main_window import MainWindow
+from agua_amiga.gui.resources import USE_BUNDLE, load_css
+imported = time.perf_counter()
+
+load_css(Gtk.CssProvider())
+MainWindow(datastore=Datastore(':memory:'))
+built = time.perf_counter()
+
+print(USE_BUNDLE, imported - start, built - imported)
+"""
+
+
+def cold_start(from_files, runs):
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    env.pop('AGUA_AMIGA_UI_FROM_FILES', None)
+    if from_files:
+        env['AGUA_AMIGA_UI_FROM_FILES'] = '1'
+
+    imports, windows = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', RUN], env=env, check=True, capture_output=True, text=True)
+        used_bundle, imported, built = output.stdout.split()
+        if used_bundle == 'True' and from_files or used_bundle == 'False' and not from_files:
+            sys.exit("agua_amiga/agua_amiga.gresource is missing, run make resources first")
+
+        imports.append(float(imported))
+        windows.append(float(built))
+
+    return statistics.median(imports), statistics.median(windows)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    for name, from_files in [('files', True), ('gresource', False)]:
+        imported, built = cold_start(from_files, runs)
+        print(f"{name:>10}: imports {imported * 1000:.1f}ms, css + main window {built * 1000:.1f}ms "
+              f"(median of {runs})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+"""
+a fake BlueZ, for running the Bluetooth stack without bottles.
+
+Serves org.bluez on a private bus with dbus-next service interfaces: an adapter, and bottles that show up
+once discovery starts. Bottles export the Hidrate Spark 3 sips characteristic and speak the sip protocol
+WaterBottle expects: they report the current sip and how many more are stored, and report the next one
+when asked with an ACK write. Each bottle starts with a backlog of stored sips, and can take live sips
+every so often after connecting. Like BlueZ, a bottle's services are exported on connect and removed on
+disconnect, at the same paths each time.
+
+    dbus-daemon --session --nofork --print-address &      a private bus, prints its address
+    python benchmarks/fake_bluez.py --address <address> --bottles 10 --backlog 50
+
+Then run the app or the daemon with AGUA_AMIGA_BUS_ADDRESS=<address>. benchmarks/bluetooth_load.py
+starts both itself.
+"""
+import argparse
+import asyncio
+import random
+import sys
+from collections import deque
+
+from dbus_next import BusType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import PropertyAccess, ServiceInterface, dbus_property, method, signal
+
+from agua_amiga.bottle_codecs import HidrateSpark3Codec
+
+BLUEZ_BUS_NAME = 'org.bluez'
+ADAPTER_PATH = '/org/bluez/hci0'
+ALIAS = 'h2o10C28'
+
+SIPS_SERVICE_UUID = '45855422-6565-4cd7-a2a9-fe8af41b85e8'
+SIPS_CHARACTERISTIC_UUID = '016e11b1-6c8a-4074-9e5a-076053f93784'
+ACK_SIP = bytes.fromhex("57")
+
+
+def bottle_address(index):
+    return f"F0:00:00:00:{index >> 8:02X}:{index & 0xff:02X}"
+
+
+def device_path(address):
+    return f"{ADAPTER_PATH}/dev_{address.replace(':', '_')}"
+
+
+def properties(interface: ServiceInterface):
+    """
+    the interface's D-Bus properties as Variants
+    """
+    return {prop.name: Variant(prop.signature, getattr(interface, prop.prop_getter.__name__))
+            for prop in ServiceInterface._get_properties(interface)}
+
+
+class ObjectManager(ServiceInterface):
+    """
+    BlueZ's ObjectManager at /. dbus-next answers GetManagedObjects itself, but sends InterfacesAdded and
+    InterfacesRemoved from the path of the object instead of from /, where clients listen for them.
+    """
+
+    def __init__(self, bus) -> None:
+        super().__init__('org.freedesktop.DBus.ObjectManager')
+        self.bus = bus
+
+    def add(self, path, interface):
+        self.bus.export(path, interface)
+        self.InterfacesAdded(path, {interface.name: properties(interface)})
+
+    def remove(self, path, interface):
+        self.bus.unexport(path, interface)
+        self.InterfacesRemoved(path, [interface.name])
+
+    @signal()
+    def InterfacesAdded(self, path, interfaces) -> 'oa{sa{sv}}':
+        return [path, interfaces]
+
+    @signal()
+    def InterfacesRemoved(self, path, interfaces) -> 'oas':
+        return [path, interfaces]
+
+
+class Adapter(ServiceInterface):
+
+    def __init__(self, discovering_callback) -> None:
+        super().__init__('org.bluez.Adapter1')
+        self.discovering_callback = discovering_callback
+        self.discovering = False
+        self.discovery_filter = {}
+
+    @method()
+    def SetDiscoveryFilter(self, discovery_filter: 'a{sv}'):
+        self.discovery_filter = discovery_filter
+
+    @method()
+    def StartDiscovery(self):
+        self._discovering(True)
+
+    @method()
+    def StopDiscovery(self):
+        self._discovering(False)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> 's':
+        return '00:00:00:00:00:01'
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Powered(self) -> 'b':
+        return True
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Discovering(self) -> 'b':
+        return self.discovering
+
+    def _discovering(self, discovering):
+        if discovering != self.discovering:
+            self.discovering = discovering
+            self.emit_properties_changed({'Discovering': discovering})
+            self.discovering_callback(discovering)
+
+
+class Device(ServiceInterface):
+
+    def __init__(self, bottle) -> None:
+        super().__init__('org.bluez.Device1')
+        self.bottle = bottle
+
+    @method()
+    async def Connect(self):
+        await self.bottle.connect()
+
+    @method()
+    def Disconnect(self):
+        self.bottle.disconnect()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> 's':
+        return self.bottle.address
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Alias(self) -> 's':
+        return ALIAS
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Name(self) -> 's':
+        return ALIAS
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Adapter(self) -> 'o':
+        return ADAPTER_PATH
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Blocked(self) -> 'b':
+        return False
+
+    @dbus_property(access=PropertyAccess.READ)
+    def RSSI(self) -> 'n':
+        return self.bottle.rssi
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Connected(self) -> 'b':
+        return self.bottle.connected
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServicesResolved(self) -> 'b':
+        return self.bottle.services_resolved
+
+
+class GattService(ServiceInterface):
+
+    def __init__(self, device_path) -> None:
+        super().__init__('org.bluez.GattService1')
+        self.device_path = device_path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return SIPS_SERVICE_UUID
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> 'b':
+        return True
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Device(self) -> 'o':
+        return self.device_path
+
+
+class SipsCharacteristic(ServiceInterface):
+
+    FLAGS = ['read', 'write', 'write-without-response', 'notify']
+
+    def __init__(self, bottle, service_path) -> None:
+        super().__init__('org.bluez.GattCharacteristic1')
+        self.bottle = bottle
+        self.service_path = service_path
+        self.value = b''
+        self.notifying = False
+
+    def notify(self, value):
+        self.value = value
+        if self.notifying:
+            self.emit_properties_changed({'Value': value})
+
+    @method()
+    def ReadValue(self, options: 'a{sv}') -> 'ay':
+        self.value = self.bottle.report_sip()
+        return self.value
+
+    @method()
+    def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        if bytes(value) == ACK_SIP:
+            # answered after the write returns, like the bottle does
+            asyncio.get_running_loop().call_soon(self.bottle.ack_sip)
+
+    @method()
+    def StartNotify(self):
+        if not self.notifying:
+            self.notifying = True
+            self.emit_properties_changed({'Notifying': True})
+
+    @method()
+    def StopNotify(self):
+        if self.notifying:
+            self.notifying = False
+            self.emit_properties_changed({'Notifying': False})
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return SIPS_CHARACTERISTIC_UUID
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> 'o':
+        return self.service_path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return self.FLAGS
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> 'ay':
+        return self.value
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Notifying(self) -> 'b':
+        return self.notifying
+
+
+class FakeBottle:
+    """
+    one bottle, sips are (percent of the bottle, ms ago) oldest first
+    """
+    codec = HidrateSpark3Codec()
+
+    def __init__(self, object_manager: ObjectManager, index, backlog=0, live_sips=0, live_interval_s=1.0,
+                 connect_delay_s=0.0) -> None:
+        self.object_manager = object_manager
+        self.address = bottle_address(index)
+        self.path = device_path(self.address)
+        self.service_path = f"{self.path}/service000a"
+        self.characteristic_path = f"{self.service_path}/char000b"
+        self.rssi = -40 - index % 50
+        self.live_sips = live_sips
+        self.live_interval_s = live_interval_s
+        self.connect_delay_s = connect_delay_s
+
+        self.connected = False
+        self.services_resolved = False
+        self.total = 0
+        self.sips = deque()
+        for sip in range(backlog):
+            self.add_sip(random.randint(1, 20), (backlog - sip) * 60_000)
+
+        self.device = Device(self)
+        self.service = GattService(self.path)
+        self.characteristic = SipsCharacteristic(self, self.service_path)
+        self._live_sips_handle = None
+
+    def discovered(self):
+        self.object_manager.add(self.path, self.device)
+
+    async def connect(self):
+        if self.connected:
+            return
+
+        await asyncio.sleep(self.connect_delay_s)
+        self.connected = True
+        self.device.emit_properties_changed({'Connected': True})
+
+        self.object_manager.add(self.service_path, self.service)
+        self.object_manager.add(self.characteristic_path, self.characteristic)
+        self.services_resolved = True
+        self.device.emit_properties_changed({'ServicesResolved': True})
+
+        if self.live_sips:
+            self._live_sips_handle = asyncio.get_running_loop().call_later(self.live_interval_s, self._live_sip)
+
+    def disconnect(self):
+        if not self.connected:
+            return
+
+        if self._live_sips_handle:
+            self._live_sips_handle.cancel()
+            self._live_sips_handle = None
+
+        self.characteristic.notifying = False
+        self.services_resolved = False
+        self.device.emit_properties_changed({'ServicesResolved': False})
+        self.object_manager.remove(self.characteristic_path, self.characteristic)
+        self.object_manager.remove(self.service_path, self.service)
+        self.connected = False
+        self.device.emit_properties_changed({'Connected': False})
+
+    def add_sip(self, percent, ms_ago=0):
+        self.total += round(self.codec.bottle_size * percent / 100)
+        self.sips.append((percent, ms_ago))
+
+    def report_sip(self):
+        """
+        the payload for the oldest stored sip. A sip reported with none left after it
+        is forgotten right away, since it won't be ACKed.
+        """
+        if not self.sips:
+            return self.codec.layout.pack(0, 0, self.total & 0xffff, 0)
+
+        percent, ms_ago = self.sips[0]
+        sips_left = len(self.sips) - 1
+        if not sips_left:
+            self.sips.popleft()
+
+        return self.codec.layout.pack(min(sips_left, 0xff), percent, self.total & 0xffff, ms_ago)
+
+    def ack_sip(self):
+        # the ACK makes the bottle forget the sip it reported and send the next one
+        if self.sips:
+            self.sips.popleft()
+        if self.sips:
+            self.characteristic.notify(self.report_sip())
+
+    def _live_sip(self):
+        self.live_sips -= 1
+        was_idle = not self.sips
+        self.add_sip(random.randint(1, 20))
+        if was_idle:
+            self.characteristic.notify(self.report_sip())
+
+        self._live_sips_handle = asyncio.get_running_loop().call_later(self.live_interval_s, self._live_sip) \
+            if self.live_sips else None
+
+
+class FakeBluez:
+    """
+    the adapter and bottles, bottles are found the first time discovery starts
+    """
+
+    def __init__(self, bus, bottles=1, **bottle_options) -> None:
+        self.bus = bus
+        self.object_manager = ObjectManager(bus)
+        self.adapter = Adapter(self._discovering)
+        self.bottles = [FakeBottle(self.object_manager, index, **bottle_options) for index in range(bottles)]
+        self._discovered = False
+
+    async def start(self):
+        self.bus.export('/', self.object_manager)
+        self.object_manager.add(ADAPTER_PATH, self.adapter)
+        await self.bus.request_name(BLUEZ_BUS_NAME)
+        return self
+
+    def _discovering(self, discovering):
+        if discovering and not self._discovered:
+            self._discovered = True
+            for bottle in self.bottles:
+                bottle.discovered()
+
+
+async def serve(address, bottles, **bottle_options):
+    bus = await MessageBus(bus_address=address, bus_type=BusType.SESSION).connect()
+    await FakeBluez(bus, bottles, **bottle_options).start()
+    # whoever started us waits for this line
+    print("ready", flush=True)
+    await bus.wait_for_disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serves a fake org.bluez with simulated bottles")
+    parser.add_argument('--address', required=True, help="D-Bus address of the bus to serve on")
+    parser.add_argument('--bottles', type=int, default=1)
+    parser.add_argument('--backlog', type=int, default=0, help="sips stored on each bottle")
+    parser.add_argument('--live-sips', type=int, default=0, help="sips each bottle takes after connecting")
+    parser.add_argument('--live-interval', type=float, default=1.0, help="seconds between live sips")
+    parser.add_argument('--connect-delay', type=float, default=0.0, help="seconds each Connect takes")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.address, args.bottles, backlog=args.backlog, live_sips=args.live_sips,
+                          live_interval_s=args.live_interval, connect_delay_s=args.connect_delay))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+compares saving sips one transaction at a time with Datastore.save_sips.
+
+run with: python benchmarks/ingest.py [number of sips]
+"""
+import os.path
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from agua_amiga.datastore import Datastore
+
+
+def make_sips(count):
+    start = datetime.now() - timedelta(days=30)
+    return [(20.0, start + timedelta(minutes=i), 'bench') for i in range(count)]
+
+
+def bench_single(db_path, sips):
+    datastore = Datastore(db_path)
+    start = time.perf_counter()
+    for sip in sips:
+        datastore.save_sip(*sip)
+
+    return time.perf_counter() - start
+
+
+def bench_batched(db_path, sips):
+    datastore = Datastore(db_path)
+    start = time.perf_counter()
+    datastore.save_sips(sips)
+
+    return time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sips = make_sips(count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, bench in [('single', bench_single), ('batched', bench_batched)]:
+            elapsed = bench(os.path.join(directory, f'{name}.db'), sips)
+            print(f"{name:>8}: {count} sips in {elapsed:.3f}s, {count / elapsed:,.0f} sips/s")
+
+
+if __name__ == '__main__':
+    main()